@@ -0,0 +1,174 @@
+"""
+Audio output
+
+libspotify delivers PCM data on its own thread, and used to wait while we
+wrote it to the sound card. Now music_delivery only copies the data into a
+preallocated ring buffer, and a separate thread writes the ring buffer to the
+audio sink. When a track is stopped or switched, the buffer is simply
+emptied.
+
+The output keeps track of the time from play() until the first frame is
+handed to the sink, and of the number of times the buffer ran dry while
+playing, for the track being played. With a NullSink this can be measured
+without a sound card.
+"""
+import threading
+import time
+
+# Two seconds of 44.1 kHz, 16 bit stereo
+BUFFER_SIZE = 2 * 44100 * 2 * 2
+
+# Number of frames written to the sink at a time
+CHUNK_FRAMES = 2048
+
+
+class RingBuffer(object):
+	"""Fixed size byte buffer. Not thread safe, AudioOutput does the locking."""
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.data     = bytearray(capacity)
+		self.view     = memoryview(self.data)
+		self.start    = 0 # position of the oldest byte
+		self.length   = 0 # number of bytes in the buffer
+
+	def free(self):
+		return self.capacity - self.length
+
+	def write(self, src):
+		"""Copies as much of the memoryview src as there is room for. Returns the number of bytes copied."""
+		n = min(len(src), self.free())
+		end = (self.start + self.length) % self.capacity
+		first = min(n, self.capacity - end)
+
+		self.view[end:end + first] = src[:first]
+		if n > first:
+			self.view[0:n - first] = src[first:n]
+
+		self.length += n
+		return n
+
+	def read(self, size):
+		"""Removes and returns up to size bytes"""
+		n = min(size, self.length)
+		first = min(n, self.capacity - self.start)
+
+		data = self.view[self.start:self.start + first].tobytes()
+		if n > first:
+			data += self.view[0:n - first].tobytes()
+
+		self.start = (self.start + n) % self.capacity
+		self.length -= n
+		return data
+
+	def clear(self):
+		self.start = 0
+		self.length = 0
+
+
+class ControllerSink(object):
+	"""Writes to an AlsaController or OssController from pyspotify"""
+	def __init__(self, controller):
+		self.controller = controller
+
+	def write(self, data, frame_size, sample_type, sample_rate, channels):
+		self.controller.music_delivery(None, data, frame_size, len(data) // frame_size, sample_type, sample_rate, channels)
+
+
+class NullSink(object):
+	"""
+	Throws the audio away. If realtime is True, it takes as long as playing
+	the audio would, like a real sound card.
+	"""
+	def __init__(self, realtime = True):
+		self.realtime = realtime
+		self.frames   = 0
+
+	def write(self, data, frame_size, sample_type, sample_rate, channels):
+		frames = len(data) // frame_size
+		self.frames += frames
+		if self.realtime:
+			time.sleep(frames / float(sample_rate))
+
+
+class AudioOutput(threading.Thread):
+	def __init__(self, sink, size = BUFFER_SIZE):
+		threading.Thread.__init__(self)
+		self.daemon = True
+
+		self.sink   = sink
+		self.ring   = RingBuffer(size)
+		self.lock   = threading.Condition()
+		self.format = None # (frame_size, sample_type, sample_rate, channels)
+
+		self.playing  = False
+		self.stopped  = False
+		self.starved  = False
+
+		# Measurements
+		self.play_time           = None
+		self.first_frame_latency = None # seconds from play() to the first frame written to the sink
+		self.underruns           = 0
+
+		self.start()
+
+	def music_delivery(self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels):
+		"""
+		Called from libspotify. Copies as many whole frames as there is room
+		for and returns the number of frames copied. libspotify delivers the
+		rest again later.
+		"""
+		with self.lock:
+			audio_format = (frame_size, sample_type, sample_rate, channels)
+			if audio_format != self.format:
+				# Play what we have in the old format first
+				if self.ring.length:
+					return 0
+				self.format = audio_format
+
+			n = min(num_frames, self.ring.free() // frame_size)
+			if n:
+				self.ring.write(memoryview(frames)[:n * frame_size])
+				self.lock.notify()
+			return n
+
+	def play(self):
+		with self.lock:
+			self.playing = True
+			self.starved = False
+			self.play_time = time.time()
+			self.first_frame_latency = None
+			self.underruns = 0
+
+	def flush(self):
+		"""Stops playing and throws away everything in the buffer"""
+		with self.lock:
+			self.playing = False
+			self.ring.clear()
+
+	def close(self):
+		"""Stops the thread. Nothing is written to the sink after it is done."""
+		with self.lock:
+			self.stopped = True
+			self.lock.notify()
+
+	def run(self):
+		while True:
+			with self.lock:
+				while not self.ring.length and not self.stopped:
+					if self.playing and self.first_frame_latency is not None and not self.starved:
+						self.underruns += 1
+						self.starved = True
+					self.lock.wait()
+
+				if self.stopped:
+					return
+
+				self.starved = False
+				audio_format = self.format
+				data = self.ring.read(CHUNK_FRAMES * audio_format[0])
+
+				if self.playing and self.first_frame_latency is None:
+					self.first_frame_latency = time.time() - self.play_time
+
+			# Write without holding the lock, so libspotify can keep delivering
+			self.sink.write(data, *audio_format)
@@ -0,0 +1,114 @@
+"""
+Persistent track catalogue
+
+Every track uploaded by a client is stored in an SQLite database, together
+with the usernames of the players that contributed it. When a player joins a
+game, the game is seeded with the tracks that player has contributed before,
+so games can start right after a restart without waiting for uploads.
+
+The database is only used from a thread of its own. Writes are queued and
+done in batched transactions, and reads return Deferreds, so the reactor
+never waits for the disk.
+"""
+from conf import *
+
+import Queue
+import sqlite3
+import threading
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+	uri    TEXT PRIMARY KEY,
+	artist TEXT NOT NULL,
+	title  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contributions (
+	username TEXT NOT NULL,
+	uri      TEXT NOT NULL,
+	PRIMARY KEY (username, uri)
+);
+"""
+
+# Marks the end of the queue
+STOP = object()
+
+
+class Catalogue(threading.Thread):
+	def __init__(self, path):
+		threading.Thread.__init__(self)
+		self.daemon = True
+
+		self.path  = path
+		self.queue = Queue.Queue() # ('add', username, tracks) or ('tracks', username, limit, deferred)
+		self.start()
+
+	def add(self, username, tracks):
+		"""Stores [(uri, artist, title)] contributed by username"""
+		self.queue.put(('add', username, tracks))
+
+	def tracks_for(self, username, limit = SEED_TRACKS):
+		"""Returns a Deferred firing with up to limit tracks contributed by username"""
+		d = defer.Deferred()
+		self.queue.put(('tracks', username, limit, d))
+		return d
+
+	def close(self):
+		"""Writes everything still queued and stops the thread"""
+		self.queue.put(STOP)
+		self.join()
+
+	def run(self):
+		db = sqlite3.connect(self.path)
+		# Artists and titles are utf-8 encoded strings
+		db.text_factory = str
+		db.executescript(SCHEMA)
+
+		while True:
+			# Wait for work, then take everything that is queued up to a batch
+			items = [self.queue.get()]
+			while len(items) < CATALOGUE_BATCH:
+				try:
+					items.append(self.queue.get_nowait())
+				except Queue.Empty:
+					break
+
+			stop = STOP in items
+			self.write(db, [i for i in items if i is not STOP and i[0] == 'add'])
+
+			for item in items:
+				if item is not STOP and item[0] == 'tracks':
+					self.read(db, *item[1:])
+
+			if stop:
+				break
+
+		db.close()
+
+	def write(self, db, items):
+		if not items:
+			return
+
+		try:
+			with db:
+				for _, username, tracks in items:
+					db.executemany("INSERT OR IGNORE INTO tracks (uri, artist, title) VALUES (?, ?, ?)", tracks)
+					db.executemany("INSERT OR IGNORE INTO contributions (username, uri) VALUES (?, ?)",
+						[(username, t[0]) for t in tracks])
+		except sqlite3.Error, e:
+			log.msg("Catalogue: Failed to store tracks: %s" % e)
+
+	def read(self, db, username, limit, d):
+		try:
+			tracks = db.execute("""
+				SELECT tracks.uri, tracks.artist, tracks.title
+				FROM contributions JOIN tracks ON tracks.uri = contributions.uri
+				WHERE contributions.username = ?
+				LIMIT ?""", (username, limit)).fetchall()
+		except sqlite3.Error, e:
+			log.msg("Catalogue: Failed to read tracks: %s" % e)
+			tracks = []
+
+		reactor.callFromThread(d.callback, [tuple(t) for t in tracks])
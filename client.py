@@ -21,8 +21,6 @@ Known issues:
  * Sometimes Spotify takes some time before album covers are available.
    The game will continue without this, but it may make it impossible to
    select the correct alternative.
- * C-c during startup might send the KeyboardInterrupt to SpotifySession, 
-   which will ignore it.
 
 Usage:
  python client.py ip.of.server port
@@ -32,9 +30,9 @@ If you want to run a "dumb" client that has no GUI and plays no music:
 
 """
 
-import gui
 import spotifysession
 
+import collections
 import getpass
 import pickle
 import random
@@ -43,7 +41,7 @@ import time
 
 from spotify import Link
 
-from twisted.internet import protocol, stdio
+from twisted.internet import protocol
 from twisted.protocols import basic
 from twisted.internet import reactor
 
@@ -56,19 +54,167 @@ PLAY_MUSIC = True
 # If False, the client will be participating in games, but not able to respond.
 DISPLAY_GUI = True
 
+# Maximum number of tracks sent to the server in one message, and the number
+# of seconds between each upload while there are tracks waiting to be sent.
+TRACKS_PER_UPLOAD = 50
+UPLOAD_INTERVAL   = 1
+
+# Seconds between each attempt to reconnect after losing the connection.
+# We keep trying as long as the server keeps our seat.
+RECONNECT_DELAY = 1
+
+class UploadLedger(object):
+	"""
+	Keeps track of which tracks the server has, keyed by spotify uri.
+	
+	A track is PENDING until it is sent, SENT until the server acknowledges
+	it and ACKNOWLEDGED after that. Every track is sent once per server side
+	catalogue; if we end up in a different catalogue, everything is sent again.
+	"""
+	PENDING, SENT, ACKNOWLEDGED = range(3)
+	
+	def __init__(self):
+		self.state     = {} # uri -> PENDING, SENT or ACKNOWLEDGED
+		self.tracks    = {} # uri -> (uri, artist, title)
+		self.pending   = collections.deque() # uris in the order they were added
+		self.catalogue = None
+	
+	def __contains__(self, uri):
+		return uri in self.state
+	
+	def __len__(self):
+		return len(self.state)
+	
+	def add(self, track):
+		"""Adds a (uri, artist, title) track. Returns False if it is already known."""
+		uri = track[0]
+		if uri in self.state:
+			return False
+		
+		self.tracks[uri] = track
+		self.state[uri] = self.PENDING
+		self.pending.append(uri)
+		return True
+	
+	def next_batch(self, size):
+		"""Returns up to size pending tracks and marks them as sent."""
+		batch = []
+		while self.pending and len(batch) < size:
+			uri = self.pending.popleft()
+			if self.state[uri] == self.PENDING:
+				self.state[uri] = self.SENT
+				batch.append(self.tracks[uri])
+		return batch
+	
+	def acknowledge(self, catalogue, uris):
+		"""Called when the server confirms that uris are in its catalogue."""
+		if self.catalogue is not None and catalogue != self.catalogue:
+			# Different catalogue, it has none of the tracks we sent before
+			self.reset()
+		self.catalogue = catalogue
+		
+		for uri in uris:
+			if uri in self.state:
+				self.state[uri] = self.ACKNOWLEDGED
+	
+	def resend_unacknowledged(self):
+		"""Sent tracks may have been lost with the connection. Send them again."""
+		for uri, state in self.state.items():
+			if state == self.SENT:
+				self.state[uri] = self.PENDING
+				self.pending.append(uri)
+	
+	def reset(self):
+		"""Marks every track as pending, e.g. when connecting to a new server."""
+		self.catalogue = None
+		self.pending.clear()
+		for uri in self.tracks.keys():
+			self.state[uri] = self.PENDING
+			self.pending.append(uri)
+
 class Client(object):
 	def __init__(self, username):
 		self.username = username
 		self.running  = False
+		self.answered = None # the key we answered in the current round
+		
+		self.total_score = 0
+		
+		# Startup. We join a game once both the server connection and
+		# Spotify are ready, whichever comes last.
+		self.launched      = time.time()
+		self.connection    = None
+		self.spotify_ready = False
+		self.joined        = False
+		
+		# Session on the server, used to resume after losing the connection
+		self.token           = None
+		self.grace           = 0 # seconds the server keeps our seat
+		self.last_seq        = 0 # sequence number of the last message received
+		self.disconnected_at = None
 		
 		# Internal bookkeeping
-		self.sent_tracks   = []
-		self.loaded_tracks = []
+		self.uploads        = UploadLedger()
+		self.uploading      = False
+		self.container      = None # the playlist container, once we are watching it
+		self.container_size = 0 # number of playlists in it the last time we walked it
+		self.unscanned      = [] # playlists that we have not scanned yet, loaded or not
+		self.playlists      = {} # playlist uri -> playlist, for every playlist we have scanned
+		self.unloaded       = {} # playlist uri -> tracks in it that are not loaded yet, if any
 
 	def set_connection(self, connection):
 		self.connection = connection
 	
 	def run(self):
+		if self.token:
+			self.resume()
+		else:
+			self.join_when_ready()
+	
+	def connection_lost(self):
+		self.connection = None
+		self.disconnected_at = time.time()
+	
+	def should_reconnect(self):
+		"""True if the server still keeps our seat"""
+		return self.token and time.time() - self.disconnected_at < self.grace
+	
+	def resume(self):
+		d = {
+			'action': 'resume',
+			'token': self.token,
+			'seq': self.last_seq
+		}
+		self.connection.sendLine(pickle.dumps(d))
+		print 'Reconnected. Resuming game...'
+	
+	def session(self, args):
+		"""Called when the server has started a session for us."""
+		self.token = args['token']
+		self.grace = args['grace']
+	
+	def resumed(self, args):
+		if not args['complete']:
+			print u"Some messages were lost while we were away."
+		self.uploads.resend_unacknowledged()
+	
+	def resume_failed(self, args):
+		"""The server no longer knows our session, so start over."""
+		self.token = None
+		self.last_seq = 0
+		self.connect()
+	
+	def spotify_loaded(self):
+		"""Called in the reactor thread when Spotify has logged in and loaded metadata."""
+		self.spotify_ready = True
+		self.join_when_ready()
+	
+	def join_when_ready(self):
+		if self.joined or not self.spotify_ready or not self.connection:
+			return
+		
+		self.joined = True
+		print u"Ready in %.2f seconds." % (time.time() - self.launched)
 		self.connect()
 		
 	def connect(self):
@@ -82,35 +228,102 @@ class Client(object):
 		}
 		self.connection.sendLine(pickle.dumps(d))
 		print 'Connected. Waiting for game to start...'
-		self.send_tracks()
+		self.uploads.reset()
+		if not self.uploading:
+			self.uploading = True
+			self.send_tracks()
 	
 	def metadata_updated_callback(self, spotify):
 		"""
 		Called from libspotify when there are updates to playlists and tracks.
+		
+		We don't walk the playlist container on every update. libspotify
+		tells us about playlists added to it, and we only walk it when its
+		size has changed, e.g. when it has just loaded. Playlists that are
+		not loaded yet are checked until they are, and every playlist is
+		scanned once, when it has loaded. After that, libspotify tells us
+		about tracks added to it, wherever they are added, and we only look
+		again at tracks that were not loaded yet. Newly loaded tracks are put
+		in self.uploads for send_tracks to pick up.
 		"""
-		for playlist in spotify.playlist_container:
-			if playlist.is_loaded():
-				for track in playlist:
-					if track.is_loaded() and not track in self.loaded_tracks:
-						self.loaded_tracks.append(track)
+		container = spotify.playlist_container
+		if self.container is None:
+			self.container = container
+			container.add_playlist_added_callback(self.playlist_added)
+		
+		if len(container) != self.container_size:
+			self.container_size = len(container)
+			self.unscanned.extend(container)
+		
+		unscanned = []
+		for playlist in self.unscanned:
+			if not playlist.is_loaded():
+				unscanned.append(playlist)
+				continue
+			
+			uri = unicode(Link.from_playlist(playlist))
+			if uri not in self.playlists:
+				self.playlists[uri] = playlist
+				self.tracks_added_to_playlist(playlist, playlist, 0, uri)
+				playlist.add_tracks_added_callback(self.tracks_added_to_playlist, uri)
+		self.unscanned = unscanned
+		
+		for uri, tracks in self.unloaded.items():
+			tracks = self.check_tracks(tracks)
+			if tracks:
+				self.unloaded[uri] = tracks
+			else:
+				del self.unloaded[uri]
+	
+	def playlist_added(self, container, playlist, position, userdata):
+		"""Called from libspotify when a playlist is added to the container."""
+		self.unscanned.append(playlist)
+	
+	def tracks_added_to_playlist(self, playlist, tracks, position, uri):
+		"""Called from libspotify when tracks are added to or replaced in a playlist we have scanned."""
+		unloaded = self.check_tracks(tracks)
+		if unloaded:
+			self.unloaded.setdefault(uri, []).extend(unloaded)
+	
+	def check_tracks(self, tracks):
+		"""Hands the loaded tracks to track_loaded. Returns the tracks that are not loaded yet."""
+		unloaded = []
+		for track in tracks:
+			if track.is_loaded():
+				self.track_loaded(track)
+			else:
+				unloaded.append(track)
+		return unloaded
+	
+	def track_loaded(self, track):
+		"""Queue track for upload, unless we have seen it before."""
+		uri = unicode(Link.from_track(track, 0))
+		if uri in self.uploads:
+			return
+		
+		self.uploads.add((uri, str(track.artists()[0]), track.name()))
 	
 	def send_tracks(self):
 		"""
-		Send tracks that hasn't already been sent.
+		Send tracks that hasn't already been sent. Keeps running as long as
+		we are connected, so tracks loaded later are also sent.
 		"""
-		tracks = set(self.loaded_tracks) - set(self.sent_tracks)
-		tracks = list(tracks)
-
-		tracks = [(unicode(Link.from_track(t, 0)), str(t.artists()[0]), t.name()) for t in tracks]
-		# Rate limit
-		tracks = tracks[:50]
-
-		d = { 
-			'action': 'add_tracks',
-			'tracks': tracks
-		}
-		self.connection.sendLine(pickle.dumps(d))
-		self.sent_tracks += tracks
+		tracks = []
+		if self.connection:
+			tracks = self.uploads.next_batch(TRACKS_PER_UPLOAD)
+
+		if tracks:
+			d = { 
+				'action': 'add_tracks',
+				'tracks': tracks
+			}
+			self.connection.sendLine(pickle.dumps(d))
+		
+		reactor.callLater(UPLOAD_INTERVAL, self.send_tracks)
+	
+	def tracks_added(self, args):
+		"""Called when the server has added tracks to the catalogue of our game."""
+		self.uploads.acknowledge(args['catalogue'], args['uris'])
 
 	def load_track(self, link):
 		if PLAY_MUSIC:
@@ -150,16 +363,19 @@ class Client(object):
 		 * Wait for answer
 		"""
 		if not self.load_track(args['spotify_uri']):
-			self.ui.load_failed()
+			if DISPLAY_GUI:
+				self.ui.load_failed()
 			return
 		
-		self.ui.clear_state()
+		if DISPLAY_GUI:
+			self.ui.clear_state()
 		
-		# Load album art
-		for i, (uri, artist, title) in enumerate(args['choices']):
-			self.load_cover(uri, self.ui.add_cover, (i, self.answer))
+			# Load album art
+			for i, (uri, artist, title) in enumerate(args['choices']):
+				self.load_cover(uri, self.ui.add_cover, (i, self.answer))
 
 		self.running = True
+		self.answered = None
 		self.start = time.time()
 		self.start_playback()
 		print u"Round started."
@@ -167,7 +383,17 @@ class Client(object):
 	def end_round(self, args):
 		"""
 		Called when a round ends. If we are not participating, do nothing.
+		
+		In large rooms, only a summary of the round is sent. If we answered
+		correctly, we ask the server for our new score.
 		"""
+		if args['standings'] is not None:
+			self.total_score = args['standings'].get(self.username, 0)
+		elif args['deltas'] is not None:
+			self.total_score += args['deltas'].get(self.username, 0)
+		elif self.running and self.answered == args['summary']['correct_answer']:
+			self.request_score()
+		
 		if not self.running:
 			return
 		
@@ -175,16 +401,39 @@ class Client(object):
 		self.clear_covers()
 		self.running = False
 		
-		total_score = sum(score for username, score in args['score'] if username == self.username)
-		
 		if DISPLAY_GUI:
-			self.ui.set_score(total_score)
+			self.ui.set_score(self.total_score)
 			if(args['winner'] == self.username):
 				self.ui.winner()
 			else:
 				self.ui.loser()
 		print u"Round ended. Winner is %s"  % args['winner']
 		
+		# Check how we are doing on the server now and then
+		if args['standings'] is not None:
+			self.request_leaderboard()
+	
+	def request_score(self):
+		self.connection.sendLine(pickle.dumps({'action': 'score'}))
+	
+	def score(self, args):
+		"""Called with our score after we have asked for it."""
+		self.total_score = args['total']
+		if DISPLAY_GUI:
+			self.ui.set_score(self.total_score)
+		print u"Got %d points in round %d, %d points in total." % (args['points'], args['round'], self.total_score)
+	
+	def request_leaderboard(self):
+		self.connection.sendLine(pickle.dumps({'action': 'leaderboard'}))
+	
+	def leaderboard(self, args):
+		"""Called with the best players on the server and our own rank."""
+		print u"Leaderboard (%d players):" % args['players']
+		for i, (username, points) in enumerate(args['top']):
+			print u" %2d. %s %d" % (i + 1, username, points)
+		if args['rank']:
+			print u"You are #%d with %d points." % (args['rank'], args['points'])
+		
 	def intermission(self, args):
 		"""
 		Called whenever the server feels like notifying us that we are in 
@@ -206,6 +455,10 @@ class Client(object):
 	def answer(self, key):
 		"""Handles answers received from the GUI"""
 		stop = time.time()
+		self.answered = key
+		if not self.connection:
+			print u"Not connected, the answer was lost."
+			return
 
 		answer = {
 			'action': 'answer',
@@ -216,10 +469,16 @@ class Client(object):
 
 	def handle_action(self, line):
 		"""Dispatch action to method"""
+		# Messages in a session start with their sequence number
+		if line[:1].isdigit():
+			seq, line = line.split(' ', 1)
+			self.last_seq = int(seq)
+		
 		args = pickle.loads(line)
 		action = args.pop('action')
 		
-		if action in ('start_round', 'end_round', 'answer', 'intermission'):
+		if action in ('start_round', 'end_round', 'answer', 'intermission', 'tracks_added', 'leaderboard', 'score',
+		              'session', 'resumed', 'resume_failed'):
 			getattr(self, action)(args)
 	
 class QuizClientReceiver(basic.LineReceiver):
@@ -234,30 +493,39 @@ class QuizClientFactory(protocol.ClientFactory):
 	protocol = QuizClientReceiver
 
 	def clientConnectionFailed(self, connector, reason):
-		reactor.stop()
+		self.reconnect_or_stop(connector)
 
 	def clientConnectionLost(self, connector, reason):
-		reactor.stop()
+		self.client.connection_lost()
+		self.reconnect_or_stop(connector)
+	
+	def reconnect_or_stop(self, connector):
+		if self.client.should_reconnect():
+			reactor.callLater(RECONNECT_DELAY, connector.connect)
+		else:
+			reactor.stop()
 
 
 def main(username, password):
 	client = Client(username)
 
-	client.ui = gui.Gui()
+	# Connect to Spotify. Logging in happens in the session thread while we
+	# set up the GUI and connect to the server.
+	session = spotifysession.SpotifySession(username, password,
+		play_music = PLAY_MUSIC,
+		metadata_updated_callback = client.metadata_updated_callback,
+		ready_callback = lambda spotify: reactor.callFromThread(client.spotify_loaded),
+		login_failed_callback = lambda error: reactor.callFromThread(reactor.stop))
+	print "Waiting for Spotify.."
+
+	# Pygame is slow to import, so only do it when we need the GUI
+	client.ui = None
 	if DISPLAY_GUI:
+		import gui
+		client.ui = gui.Gui()
 		client.ui.setup()
 		reactor.callLater(0.1, client.ui.tick)
 
-	# Connect to Spotify
-	session = spotifysession.SpotifySession(username, password)
-	session.metadata_updated_callback = client.metadata_updated_callback
-	print "Waiting for Spotify.."
-		
-	# Give libspotify some time to load, so we don't start doing stuff without
-	# spotify available. Please don't C-c during the sleep...
-	# A real solution would start the game when we know that Spotify has loaded.p
-	time.sleep(6)
-
 	factory = QuizClientFactory()
 	factory.client  = client
 	factory.session = session
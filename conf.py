@@ -3,6 +3,18 @@
 MIN_PLAYERS = 1
 MAX_PLAYERS = 3
 
+# Large rooms host many players in a single game. Answers are collected in
+# windows of ANSWER_WINDOW seconds instead of being handled one by one, and
+# the end of a round is sent as a short summary. Players ask for their own
+# score when they need it.
+LARGE_ROOMS = False
+LARGE_ROOM_MAX_PLAYERS = 1000
+ANSWER_WINDOW = 0.25
+
+# Number of players with the most points in a round listed in the summary
+# sent to large rooms.
+SUMMARY_SIZE = 5
+
 # Duration of every round. If not every client has answered within this time,
 # the round will time out and the game will continue. Value is in seconds.
 ROUND_TIME = 10
@@ -19,3 +31,79 @@ NUMBER_OF_ALTERNATIVES = 4
 # The time is measured on the client, so network lag is not 
 # included in the score. It also makes it relatively easy to cheat.
 POINTS = (89, 55, 34, 21, 13, 8, 5, 3, 2, 1)
+
+# Clients are sent the points given in each round. Every this many rounds, they
+# also get a snapshot of the total score of every player.
+SCORE_SNAPSHOT_INTERVAL = 10
+
+# Maximum number of players returned when a client asks for the leaderboard.
+LEADERBOARD_SIZE = 10
+
+# Number of spectators written to in every iteration of the reactor. The rest
+# wait for the next iteration, so rounds are not delayed by spectators.
+FANOUT_BATCH = 200
+
+# Messages to a client are queued and written once per reactor iteration.
+# Of the kinds listed here, only the newest queued message is sent. Clients
+# with more than MAX_OUTBOUND_BYTES queued are disconnected.
+COALESCED_MESSAGES = ('intermission',)
+MAX_OUTBOUND_BYTES = 1024 * 1024
+
+# Seconds between each time the server logs its metrics.
+METRICS_INTERVAL = 60
+
+# Admission control. Every connection may send this many messages and bytes
+# per second, and every game accepts this many add_tracks messages and
+# tracks per second. Bursts up to the given sizes are allowed. Anything over
+# budget is handled later by the ingestion queue, which does at most
+# INGESTION_BATCH pieces of work every INGESTION_INTERVAL seconds. Clients
+# with more than MAX_DEFERRED_BYTES waiting are disconnected.
+CONNECTION_MESSAGE_RATE  = 20
+CONNECTION_MESSAGE_BURST = 50
+CONNECTION_BYTE_RATE     = 64 * 1024
+CONNECTION_BYTE_BURST    = 256 * 1024
+GAME_MESSAGE_RATE        = 50
+GAME_MESSAGE_BURST       = 100
+GAME_TRACK_RATE          = 1000
+GAME_TRACK_BURST         = 2000
+INGESTION_INTERVAL       = 0.05
+INGESTION_BATCH          = 20
+MAX_DEFERRED_BYTES       = 4 * 1024 * 1024
+
+# Uploaded tracks are stored in this SQLite database, and new games are seeded
+# with up to SEED_TRACKS tracks previously contributed by the joining players.
+# Set to None to keep tracks in memory only. Writes are batched, up to
+# CATALOGUE_BATCH uploads per transaction. Clients are told which seeded
+# tracks they don't have to upload in messages of at most
+# TRACKS_PER_ACKNOWLEDGEMENT tracks, short enough for the line length they
+# accept.
+CATALOGUE_PATH  = 'catalogue.db'
+CATALOGUE_BATCH = 100
+SEED_TRACKS     = 1000
+TRACKS_PER_ACKNOWLEDGEMENT = 50
+
+# The state of the server is saved to SNAPSHOT_PATH every SNAPSHOT_INTERVAL
+# seconds and restored when the server starts. Players from before the restart
+# keep their seats and scores for RESTORE_GRACE seconds. Set SNAPSHOT_PATH to
+# None to disable snapshots. Only what has changed is written, to a journal
+# that is folded into a new full snapshot when it grows larger than
+# SNAPSHOT_COMPACTION times the full snapshot.
+SNAPSHOT_PATH       = 'server.snapshot'
+SNAPSHOT_INTERVAL   = 10
+SNAPSHOT_COMPACTION = 1.0
+RESTORE_GRACE       = 60
+
+# Round events are appended to segments of EVENT_LOG_SEGMENT_SIZE bytes in
+# this directory. Events are buffered and written when EVENT_LOG_BUFFER bytes
+# are waiting, or every EVENT_LOG_FLUSH_INTERVAL seconds. Set EVENT_LOG_DIR to
+# None to disable the event log.
+EVENT_LOG_DIR            = 'events'
+EVENT_LOG_SEGMENT_SIZE   = 64 * 1024 * 1024
+EVENT_LOG_BUFFER         = 64 * 1024
+EVENT_LOG_FLUSH_INTERVAL = 1
+
+# Players that lose their connection keep their seat for RESUME_GRACE
+# seconds. If they reconnect in time, they get the messages they missed, as
+# long as they are among the last REPLAY_BUFFER_SIZE messages sent to them.
+RESUME_GRACE       = 30
+REPLAY_BUFFER_SIZE = 64
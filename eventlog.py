@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Round event log
+
+Every round event (start, answers, end with the points given) is appended to
+a binary log. The log is split into segments of EVENT_LOG_SEGMENT_SIZE bytes
+named events.000001.log, events.000002.log and so on. A new segment is
+started every time the server starts, so a crash can only damage the end of
+the last segment.
+
+Every record is a fixed size header followed by a marshalled tuple:
+ length of payload, kind, time, game id, payload
+
+Records are buffered and written in batches, at least every
+EVENT_LOG_FLUSH_INTERVAL seconds.
+
+The log can be replayed to rebuild the leaderboard and get the distribution
+of answer times, or to follow a single game to reproduce a bug:
+ python eventlog.py directory [game]
+
+"""
+from conf import *
+
+import leaderboard
+
+import marshal
+import mmap
+import os
+import re
+import struct
+import sys
+
+from twisted.internet import reactor
+
+ROUND_START = 1 # (round, spotify uri, choices as uris, correct answer)
+ANSWER      = 2 # (round, username, answer, time)
+ROUND_END   = 3 # (round, winner, ((username, points), ...))
+
+NAMES = {ROUND_START: 'start', ANSWER: 'answer', ROUND_END: 'end'}
+
+HEADER = struct.Struct('<IBdI')
+
+SEGMENT = re.compile(r'^events\.(\d+)\.log$')
+
+
+def segments(directory):
+	"""Returns the paths of all segments in directory, oldest first"""
+	names = []
+	for name in os.listdir(directory):
+		m = SEGMENT.match(name)
+		if m:
+			names.append((int(m.group(1)), name))
+
+	return [os.path.join(directory, name) for _, name in sorted(names)]
+
+
+class EventLog(object):
+	def __init__(self, directory):
+		self.directory = directory
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		self.buffer   = []
+		self.buffered = 0
+		self.file     = None
+		self.size     = 0
+
+		existing = segments(directory)
+		self.segment = 0
+		if existing:
+			self.segment = int(SEGMENT.match(os.path.basename(existing[-1])).group(1))
+		self.rotate()
+
+		reactor.callLater(EVENT_LOG_FLUSH_INTERVAL, self.tick)
+
+	def append(self, kind, timestamp, game, data):
+		payload = marshal.dumps(data)
+		self.buffer.append(HEADER.pack(len(payload), kind, timestamp, game))
+		self.buffer.append(payload)
+		self.buffered += HEADER.size + len(payload)
+
+		if self.buffered >= EVENT_LOG_BUFFER:
+			self.flush()
+
+	def flush(self):
+		if not self.buffer:
+			return
+
+		data = ''.join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+
+		self.file.write(data)
+		self.file.flush()
+		self.size += len(data)
+
+		if self.size >= EVENT_LOG_SEGMENT_SIZE:
+			self.rotate()
+
+	def rotate(self):
+		"""Starts a new segment"""
+		if self.file:
+			self.file.close()
+
+		self.segment += 1
+		self.file = open(os.path.join(self.directory, 'events.%06d.log' % self.segment), 'ab')
+		self.size = 0
+
+	def tick(self):
+		self.flush()
+		reactor.callLater(EVENT_LOG_FLUSH_INTERVAL, self.tick)
+
+	def close(self):
+		self.flush()
+		self.file.close()
+
+
+def read(path, kinds = None):
+	"""
+	Yields (kind, time, game, data) for every record in the segment at path.
+	Records of other kinds than those in kinds are skipped without decoding.
+	"""
+	f = open(path, 'rb')
+	try:
+		if not os.fstat(f.fileno()).st_size:
+			return
+
+		buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		try:
+			end = len(buf)
+			offset = 0
+			while offset + HEADER.size <= end:
+				length, kind, timestamp, game = HEADER.unpack_from(buf, offset)
+				offset += HEADER.size
+				if offset + length > end:
+					# Cut short by a crash
+					break
+
+				if kinds is None or kind in kinds:
+					yield kind, timestamp, game, marshal.loads(buf[offset:offset + length])
+				offset += length
+		finally:
+			buf.close()
+	finally:
+		f.close()
+
+
+def replay(directory, kinds = None):
+	"""Yields every record in the log, oldest first"""
+	for path in segments(directory):
+		for record in read(path, kinds):
+			yield record
+
+
+def summarize(directory):
+	"""Rebuilds the leaderboard and the answer time distribution from the log"""
+	totals = {} # username -> points
+	answer_times = [0] * (len(POINTS) + 1) # answers per second, the last one is for slower answers
+	rounds = 0
+
+	for kind, _, _, data in replay(directory, (ANSWER, ROUND_END)):
+		if kind == ANSWER:
+			answer_times[min(int(data[3]), len(POINTS))] += 1
+		else:
+			rounds += 1
+			for username, points in data[2]:
+				totals[username] = totals.get(username, 0) + points
+
+	# Rank everybody once at the end instead of after every round
+	board = leaderboard.Leaderboard()
+	for username, points in totals.iteritems():
+		board.add(username, points)
+
+	return rounds, answer_times, board
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print >> sys.stderr, u"""
+Usage:
+ python eventlog.py directory [game]
+"""
+		sys.exit(1)
+
+	if len(sys.argv) > 2:
+		# Everything that happened in a single game
+		game_id = int(sys.argv[2])
+		for kind, timestamp, game, data in replay(sys.argv[1]):
+			if game == game_id:
+				print u"%.3f %-6s %r" % (timestamp, NAMES.get(kind, kind), data)
+		sys.exit(0)
+
+	rounds, answer_times, board = summarize(sys.argv[1])
+
+	print u"%d rounds, %d answers, %d players" % (rounds, sum(answer_times), len(board))
+	print u"Answer times:"
+	for second, count in enumerate(answer_times):
+		label = u"%d-%d s" % (second, second + 1) if second < len(POINTS) else u"%d+ s" % second
+		print u" %-6s %d" % (label, count)
+
+	print u"Leaderboard:"
+	for i, (username, points) in enumerate(board.top(LEADERBOARD_SIZE)):
+		print u" %2d. %s %d" % (i + 1, username, points)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Spectator fan-out
+
+Spectators watch a game without playing. Every message a game sends to its
+players is also published, already pickled, to the spectators of the game.
+The same frame is shared by all spectators and is written to at most
+FANOUT_BATCH spectators per reactor iteration, so the players of the game
+never wait for the spectators.
+
+A spectator only needs the latest message of every kind. If a spectator is
+too slow to keep up, the messages it has not received yet are replaced by
+newer messages of the same kind instead of piling up. See outbound.py.
+
+To keep spectators off the game server altogether, run the fan-out in a
+separate process. It watches a game on the server as a single spectator and
+serves any number of spectators of its own:
+ python fanout.py ip.of.server port listen_port [game]
+
+"""
+from conf import *
+
+import outbound
+
+import collections
+import pickle
+import sys
+
+from twisted.internet import reactor
+from twisted.internet import protocol
+from twisted.protocols import basic
+from twisted.python import log
+
+
+class Fanout(object):
+	"""
+	Publishes frames to spectators. While subscribed, the outbound queue of
+	a spectator is a bulk queue that coalesces all kinds of messages.
+	"""
+	def __init__(self):
+		self.subscribers = {} # connection -> (coalesce, bulk) of its outbound queue before it subscribed
+		self.latest      = collections.OrderedDict() # kind -> last frame published
+
+	def __len__(self):
+		return len(self.subscribers)
+
+	def subscribe(self, connection):
+		"""Adds a spectator. It gets the latest message of every kind right away."""
+		if connection in self.subscribers:
+			return
+
+		queue = connection.outbound
+		self.subscribers[connection] = (queue.coalesce, queue.bulk)
+		queue.coalesce = None
+		queue.bulk = True
+		for kind, frame in self.latest.iteritems():
+			queue.push(kind, frame)
+
+	def unsubscribe(self, connection):
+		"""Removes a spectator and gives its outbound queue back its own settings"""
+		settings = self.subscribers.pop(connection, None)
+		if settings:
+			connection.outbound.coalesce, connection.outbound.bulk = settings
+
+	def publish(self, kind, frame):
+		"""Publishes a pickled frame to all subscribers."""
+		self.latest.pop(kind, None)
+		self.latest[kind] = frame
+
+		for connection in self.subscribers:
+			connection.outbound.push(kind, frame)
+
+
+class Relay(basic.LineReceiver):
+	"""Connection to the game server, spectating a single game."""
+	def connectionMade(self):
+		self.sendLine(pickle.dumps({'action': 'spectate', 'game': self.factory.game}))
+
+	def lineReceived(self, line):
+		kind = pickle.loads(line)['action']
+		self.factory.fanout.publish(kind, line)
+
+
+class RelayFactory(protocol.ClientFactory):
+	protocol = Relay
+
+	def clientConnectionFailed(self, connector, reason):
+		reactor.stop()
+
+	def clientConnectionLost(self, connector, reason):
+		reactor.stop()
+
+
+class Spectator(basic.LineReceiver):
+	"""Connection from a spectator to the relay. Anything it sends is ignored."""
+	def connectionMade(self):
+		self.outbound = outbound.OutboundQueue(self)
+		self.factory.fanout.subscribe(self)
+
+	def connectionLost(self, reason):
+		self.factory.fanout.unsubscribe(self)
+
+	def lineReceived(self, line):
+		pass
+
+
+if __name__ == '__main__':
+	log.startLogging(sys.stdout)
+
+	if len(sys.argv) < 4:
+		print >> sys.stderr, u"""
+Usage:
+ python fanout.py ip.of.server port listen_port [game]
+"""
+		sys.exit(1)
+
+	fanout = Fanout()
+
+	relay = RelayFactory()
+	relay.fanout = fanout
+	relay.game = None
+	if len(sys.argv) > 4:
+		relay.game = int(sys.argv[4])
+
+	factory = protocol.ServerFactory()
+	factory.protocol = Spectator
+	factory.fanout = fanout
+
+	reactor.connectTCP(sys.argv[1], int(sys.argv[2]), relay)
+	reactor.listenTCP(int(sys.argv[3]), factory)
+	reactor.run()
@@ -3,7 +3,12 @@ Game logic
 """
 from conf import *
 
-import operator
+import eventlog
+import fanout
+import ratelimit
+
+import cPickle
+import heapq
 import random
 import sys
 import string
@@ -28,25 +33,41 @@ class Game(object):
 	useful, it serves only as a pause between rounds for the players and as a
 	state to wait in when a round cannot yet start. This is the initial state.
 	
+	In a large room, answers are handled in windows of ANSWER_WINDOW seconds
+	and only a summary is sent at the end of each round.
+	
 	"""
-	def __init__(self, identification):
+	def __init__(self, identification, leaderboard = None, large_room = False, events = None):
 		self.id          = identification
+		self.leaderboard = leaderboard # server wide leaderboard, receives the points from every round
+		self.events      = events # event log, receives every round event
+		self.large_room  = large_room
+		self.max_players = LARGE_ROOM_MAX_PLAYERS if large_room else MAX_PLAYERS
 		self.clients     = []
 		self.waiting     = [] # waiting clients that will join in next round
+		self.spectators  = fanout.Fanout() # receive everything sent to the clients
 		self.users       = {} # client -> username
 		                 
-		self.score       = [] # (username, points)
+		self.standings   = {} # username -> total points
+		self.deltas      = {} # username -> points in the last round
 		self.round       = 0
 
 		self.used_tracks = [] # Songs that we have played in this game. Do not use these again.
 		self.all_tracks  = [] # Available songs. Use this for games with a certain theme.
+		self.known_tracks = set() # all_tracks as a set, for fast lookups
+		self.budget      = ratelimit.Budget(GAME_MESSAGE_RATE, GAME_MESSAGE_BURST, GAME_TRACK_RATE, GAME_TRACK_BURST)
 
 		self.is_running  = False # True when a round is in progress, False in intermission
 		self.choices     = [] # [(key, song title)]
-		self.answers     = [] # [(username, answer)]
+		self.answers     = {} # client -> (username, answer, time)
+		self.fastest     = None # (username, time) of the fastest correct answer this round
+		self.answer_window = None # pending call closing the current answer window
 		                 
 		self.callbacks   = [] # twisted callbacks
 		
+		self.reserved    = set() # usernames of players from before a restart, who may reconnect
+		self.dirty       = True # True if the game has changed since the last snapshot
+		
 		# Go to initial state
 		self.intermission()
 	
@@ -57,14 +78,26 @@ class Game(object):
 		l = u"%s: %s" % (str(self), msg)
 		log.msg(l.encode('latin-1', 'ignore'))
 	
+	def record(self, kind, *data):
+		"""Appends a round event to the event log"""
+		if self.events is not None:
+			self.events.append(kind, time.time(), self.id, data)
+	
 	def add_client(self, client, args):
 		"""
 		Adds client to game. If a game is running, the client must wait until next round.
+		Players back after a restart are told the score they had.
 		"""
-		if self.is_full():
+		restored = args['username'] in self.reserved
+		if self.is_full() and not restored:
 			return False
 		
 		self.users[client] = args['username']
+		self.reserved.discard(args['username'])
+		self.dirty = True
+		
+		if restored:
+			self.score_requested(client)
 
 		if self.is_running:
 			self.waiting.append(client)
@@ -80,11 +113,18 @@ class Game(object):
 		"""
 		Removes client from the game. May even end the current round.
 		"""
-		self.clients.remove(client)
+		if client in self.waiting:
+			self.waiting.remove(client)
+		else:
+			self.clients.remove(client)
 		username = self.users[client]
 		del self.users[client]
+		self.dirty = True
 		
-		self.score = filter(lambda score: score[0] != username, self.score)
+		self.standings.pop(username, None)
+		
+		if self.answers.pop(client, None) and self.fastest and self.fastest[0] == username:
+			self.fastest = self.find_fastest()
 		
 		if not self.enough_players() and self.is_running:
 			self.log('Round #%d: Ended because %s left' % (self.round, username))
@@ -93,8 +133,14 @@ class Game(object):
 	def add_tracks(self, client, args):
 		# Sanity check of the format
 		for spotify_uri, artist, title in args['tracks']:
-			if not (spotify_uri, artist, title) in self.all_tracks:
+			if not (spotify_uri, artist, title) in self.known_tracks:
+				self.known_tracks.add((spotify_uri, artist, title))
 				self.all_tracks.append((spotify_uri, artist, title))
+	
+	def seed_tracks(self, tracks):
+		"""Adds tracks from the catalogue, contributed by players in earlier games."""
+		self.add_tracks(None, {'tracks': tracks})
+		self.log("Seeded with %d tracks from the catalogue, %d tracks available." % (len(tracks), len(self.all_tracks)))
 
 
 	def can_start(self):
@@ -108,7 +154,7 @@ class Game(object):
 		return len(self.all_tracks) >= NUMBER_OF_ALTERNATIVES
 	
 	def is_full(self):
-		return len(self.clients) + len(self.waiting) >= MAX_PLAYERS
+		return len(self.clients) + len(self.waiting) + len(self.reserved) >= self.max_players
 
 	def start_round(self):
 		"""
@@ -128,6 +174,7 @@ class Game(object):
 		
 		self.round += 1
 		self.join_players()
+		self.dirty = True
 		
 		self.log(u"Starting round %d with %d players and %d tracks" % (self.round, len(self.clients), len(self.available_tracks())))
 		self.is_running = True
@@ -141,6 +188,7 @@ class Game(object):
 				self.correct_answer = i
 
 		self.log(u"Playing '%s - %s'. Correct answer: %d" % (track[1].decode('utf-8'), track[2].decode('utf-8'), self.correct_answer))
+		self.record(eventlog.ROUND_START, self.round, track[0], tuple(t[0] for t in self.choices), self.correct_answer)
 		
 		d = { 
 			'action': 'start_round', 
@@ -160,19 +208,46 @@ class Game(object):
 
 		self.stop_callbacks()
 		
-		# Sort answers by time. answer = (username, answer, time)
-		answers = sorted(self.answers, key = operator.itemgetter(2))
-		self.answers = []		
-		# Find all correct answers.
-		correct_answers = filter(lambda a: a[1] == self.correct_answer, answers)
-		
 		winner = None
-		for username, _, time in correct_answers:
-			if not winner:
-				winner = username
-			self.score.append((username, self.time_to_points(time)))
+		if self.fastest:
+			winner = self.fastest[0]
+		
+		deltas = {} # username -> points this round
+		for username, answer, time in self.answers.itervalues():
+			if answer == self.correct_answer:
+				deltas[username] = self.time_to_points(time)
+		
+		number_of_answers = len(self.answers)
+		self.answers = {}
+		self.fastest = None
+		self.answer_window = None
 		
-		self.notify_clients({'action': 'end_round', 'winner': winner, 'score': self.score})
+		for username, points in deltas.iteritems():
+			self.standings[username] = self.standings.get(username, 0) + points
+		self.deltas = deltas
+		self.dirty = True
+		self.record(eventlog.ROUND_END, self.round, winner, tuple(deltas.iteritems()))
+		
+		if self.leaderboard is not None:
+			self.leaderboard.add_scores(deltas)
+		
+		if self.large_room:
+			# Players ask for their own score, see score_requested
+			summary = {
+				'correct_answer': self.correct_answer,
+				'answers': number_of_answers,
+				'correct': len(deltas),
+				'top': heapq.nlargest(SUMMARY_SIZE, deltas.iteritems(), key = lambda d: d[1])
+			}
+			self.notify_clients({'action': 'end_round', 'winner': winner, 'deltas': None, 'standings': None, 'summary': summary})
+		else:
+			# Only this round's points are sent, with a full snapshot of the
+			# standings now and then so clients can't drift.
+			standings = None
+			if self.round % SCORE_SNAPSHOT_INTERVAL == 0:
+				standings = self.standings.copy()
+			
+			self.notify_clients({'action': 'end_round', 'winner': winner, 'deltas': deltas, 'standings': standings})
 		self.log("Round #%d ended. Winner is %s" % (self.round, winner))
 		
 		self.intermission()
@@ -202,6 +277,7 @@ class Game(object):
 	def stop_callbacks(self):
 		"""Stops any pending Twisted callbacks, such as timeouts"""
 		[c.cancel() for c in self.callbacks if c.active()]		
+		self.callbacks = []
 	
 	def select_track(self):
 		"""Selects a random track from the list of available tracks."""
@@ -221,24 +297,32 @@ class Game(object):
 		return tracks
 	
 	def generate_choices(self, track):
-		"""Returns a list of tracks in random order. The list includes the correct answer."""
-		assert len(self.available_tracks()) >= NUMBER_OF_ALTERNATIVES, "Running out of tracks. Crashing..."
+		"""
+		Returns a list of tracks in random order. The list includes the correct answer.
+		
+		We don't want the same artist twice, but if there are not enough
+		artists, tracks by the same artist are used rather than looking forever.
+		"""
+		available = list(self.available_tracks())
+		assert len(available) >= NUMBER_OF_ALTERNATIVES, "Running out of tracks. Crashing..."
+		
+		random.shuffle(available)
+		candidates = [t for t in available if t != track]
 		
 		tracks = [track]
-		i = 0
-		while True:
+		artists = set([track[1]])
+		for t in candidates:
 			if len(tracks) == NUMBER_OF_ALTERNATIVES:
 				break
-			
-			track = random.choice(list(self.available_tracks()))
-			if track in tracks:
-				continue
-			
-			# We don't want the same artist twice
-			if filter(lambda t: t[1] == track[1], tracks):
-				continue
-			
-			tracks.append(track)
+			if t[1] not in artists:
+				tracks.append(t)
+				artists.add(t[1])
+		
+		for t in candidates:
+			if len(tracks) == NUMBER_OF_ALTERNATIVES:
+				break
+			if t not in tracks:
+				tracks.append(t)
 		
 		random.shuffle(tracks)
 		return tracks
@@ -276,10 +360,20 @@ class Game(object):
 		time     = args['time']
 		
 		# If this user has already answered, do nothing
-		if filter(lambda a: a[0] == username, self.answers):
+		if client in self.answers:
 			return None
 		
-		self.answers.append((username, answer, time))
+		self.answers[client] = (username, answer, time)
+		self.record(eventlog.ANSWER, self.round, username, answer, time)
+		if answer == self.correct_answer and (not self.fastest or time < self.fastest[1]):
+			self.fastest = (username, time)
+		
+		if self.large_room:
+			# Check if everybody has answered once per window, not for every answer
+			if not self.answer_window:
+				self.answer_window = reactor.callLater(ANSWER_WINDOW, self.close_answer_window)
+				self.callbacks.append(self.answer_window)
+			return
 	
 		if len(self.answers) == len(self.clients):
 			self.log("%s answered %s. Received all answers, ending round." % (username, answer))
@@ -287,7 +381,69 @@ class Game(object):
 		else:
 			self.log("%s answered %s. Waiting for %d clients to answer." % (username, answer, len(self.clients) - len(self.answers)))
 
+	def close_answer_window(self):
+		"""Called at the end of an answer window in large rooms"""
+		self.answer_window = None
+		if len(self.answers) >= len(self.clients):
+			self.log("Received all %d answers, ending round." % len(self.answers))
+			self.end_round()
+		else:
+			self.log("Received %d of %d answers." % (len(self.answers), len(self.clients)))
+	
+	def score_requested(self, client):
+		"""Sends the points in the last round and the total score to the client"""
+		username = self.users[client]
+		client.send({
+			'action': 'score',
+			'round': self.round,
+			'points': self.deltas.get(username, 0),
+			'total': self.standings.get(username, 0)
+		})
+
+	def snapshot(self):
+		"""Returns the state of the game that should survive a restart"""
+		return {
+			'id': self.id,
+			'large_room': self.large_room,
+			'round': self.round,
+			'roster': self.users.values() + list(self.reserved),
+			'standings': self.standings,
+			'used_tracks': self.used_tracks
+		}
+	
+	def restore(self, state):
+		"""
+		Restores a snapshot. The players in the roster keep their seats and
+		scores until expire_reserved is called.
+		"""
+		self.round       = state['round']
+		self.standings   = state['standings']
+		self.used_tracks = state['used_tracks']
+		self.reserved    = set(state['roster'])
+		self.dirty       = False
+	
+	def expire_reserved(self):
+		"""Gives up the seats of players that did not reconnect after a restart"""
+		for username in self.reserved:
+			self.standings.pop(username, None)
+		
+		if self.reserved:
+			self.log("%d players did not reconnect after the restart." % len(self.reserved))
+			self.reserved = set()
+			self.dirty = True
+
+	def find_fastest(self):
+		"""Returns (username, time) of the fastest correct answer, or None"""
+		fastest = None
+		for username, answer, time in self.answers.itervalues():
+			if answer == self.correct_answer and (not fastest or time < fastest[1]):
+				fastest = (username, time)
+		return fastest
+
 	def notify_clients(self, d):
-		"""Sends the Python object d to all clients"""
+		"""Sends the Python object d to all clients and spectators. d is only pickled once."""
+		frame = cPickle.dumps(d)
 		for client in self.clients:
-			client.send(d)
+			client.send_frame(frame, d['action'])
+		
+		self.spectators.publish(d['action'], frame)
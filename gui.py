@@ -5,6 +5,8 @@ Simple GUI
 import cStringIO
 import string
 
+from collections import OrderedDict
+
 from twisted.internet import reactor
 
 import pygame
@@ -18,6 +20,44 @@ COVER_WIDTH  = 150
 
 NUMBER_OF_COVERS = 4
 
+# Maximum number of rendered text surfaces kept around. Score and state texts
+# repeat a lot, so a small cache covers nearly everything we draw.
+TEXT_CACHE_SIZE = 64
+
+
+class TextCache(object):
+	"""
+	Font registry and rendered text cache.
+	
+	Fonts are loaded once per size. Rendered surfaces are keyed by
+	(text, size, colour) and the least recently used surface is evicted when
+	the cache is full. Surfaces are never modified after rendering, so the
+	same surface can be blitted any number of times.
+	"""
+	def __init__(self, max_surfaces = TEXT_CACHE_SIZE):
+		self.max_surfaces = max_surfaces
+		self.fonts        = {} # size -> pygame.font.Font
+		self.surfaces     = OrderedDict() # (text, size, colour) -> Surface
+	
+	def font(self, size):
+		font = self.fonts.get(size)
+		if font is None:
+			font = self.fonts[size] = pygame.font.Font(None, size)
+		return font
+	
+	def render(self, text, size, colour):
+		"""Returns a surface with text rendered in the given size and colour."""
+		key = (text, size, colour)
+		surface = self.surfaces.pop(key, None)
+		if surface is None:
+			surface = self.font(size).render(text, 1, colour)
+			if len(self.surfaces) >= self.max_surfaces:
+				self.surfaces.popitem(last = False)
+		
+		# Reinsert to mark as most recently used
+		self.surfaces[key] = surface
+		return surface
+
 
 class Cover(pygame.sprite.Sprite):
 	"""
@@ -79,6 +119,8 @@ class Gui(object):
 		self.score = 0
 		self.score_pos = None
 		self.state_pos = None
+		
+		self.text = TextCache()
 
 	def setup(self):
 		pygame.init()
@@ -93,8 +135,7 @@ class Gui(object):
 		self.background = self.background.convert()
 		self.background.fill((255, 255, 255))
 	
-		font = pygame.font.Font(None, 64)
-		title = font.render(u"Spotify Quiz", 1, (20, 20, 20))
+		title = self.text.render(u"Spotify Quiz", 64, (20, 20, 20))
 		pos = title.get_rect(centerx = self.background.get_width() / 2)
 		self.background.blit(title, pos)	
 		
@@ -107,8 +148,7 @@ class Gui(object):
 		self.sprites = pygame.sprite.RenderPlain()
 	
 	def show_loading(self):
-		loading_font = pygame.font.Font(None, 32)
-		loading = loading_font.render(u"Waiting for Spotify...", 1, (10, 10, 10))
+		loading = self.text.render(u"Waiting for Spotify...", 32, (10, 10, 10))
 		self.loading_pos = loading.get_rect(centerx = self.background.get_width() / 2, centery = self.background.get_height() / 2)
 		self.background.blit(loading, self.loading_pos)		
 	
@@ -147,14 +187,12 @@ class Gui(object):
 		if self.score_pos:
 			pygame.draw.rect(self.screen, (255, 255, 255), self.score_pos)
 		
-		font = pygame.font.Font(None, 24)
-		text = font.render(u"Score: %d" % score, 1, (10, 10, 10))
+		text = self.text.render(u"Score: %d" % score, 24, (10, 10, 10))
 		self.score_pos = text.get_rect(topleft = (10, 10))
 		self.screen.blit(text, self.score_pos)
 		
 	def display_state(self, state):
-		font = pygame.font.Font(None, 32)
-		text = font.render(state, 1, (10, 10, 10))
+		text = self.text.render(state, 32, (10, 10, 10))
 		self.state_pos = text.get_rect(centerx = self.background.get_width() / 2, centery = HEIGHT - 50)
 		self.screen.blit(text, self.state_pos)
 		
@@ -0,0 +1,188 @@
+"""
+Server wide leaderboard
+
+Every game reports the points given in each round to the leaderboard, which
+keeps the total for every player that has played on this server. Players are
+ranked in an indexable skip list, so updating a score and looking up the rank
+of a player is O(log n) and the top k players is O(log n + k). Nothing is
+ever sorted in full.
+"""
+import math
+import random
+
+# Enough levels for far more players than we will ever see
+MAX_LEVELS = 32
+
+
+class Node(object):
+	__slots__ = ('key', 'next', 'width')
+
+	def __init__(self, key, levels):
+		self.key   = key
+		self.next  = [None] * levels
+		self.width = [1] * levels # number of nodes skipped by next[level]
+
+
+class SkipList(object):
+	"""
+	Sorted collection of unique keys with lookup by position.
+
+	Based on the indexable skip list: every link knows how many nodes it
+	skips, so positions can be found while walking down the levels.
+	"""
+	def __init__(self):
+		self.tail = Node(None, 0)
+		self.head = Node(None, MAX_LEVELS)
+		self.head.next = [self.tail] * MAX_LEVELS
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def before(self, node, key):
+		"""True if node comes before key in the list"""
+		return node is not self.tail and node.key < key
+
+	def find(self, key):
+		"""
+		Returns the nodes preceding key on every level, and the number of
+		nodes each of them is from the head.
+		"""
+		chain = [None] * MAX_LEVELS
+		steps = [0] * MAX_LEVELS
+		node = self.head
+		position = 0
+		for level in reversed(xrange(MAX_LEVELS)):
+			while self.before(node.next[level], key):
+				position += node.width[level]
+				node = node.next[level]
+			chain[level] = node
+			steps[level] = position
+		return chain, steps
+
+	def insert(self, key):
+		chain, steps = self.find(key)
+		position = steps[0] + 1 # position of the new node
+
+		levels = min(MAX_LEVELS, 1 - int(math.log(1.0 - random.random(), 2.0)))
+		node = Node(key, levels)
+		for level in xrange(levels):
+			previous = chain[level]
+			node.next[level] = previous.next[level]
+			previous.next[level] = node
+			node.width[level] = steps[level] + previous.width[level] - position + 1
+			previous.width[level] = position - steps[level]
+
+		for level in xrange(levels, MAX_LEVELS):
+			chain[level].width[level] += 1
+
+		self.size += 1
+
+	def extend(self, keys):
+		"""
+		Builds the list from keys, which must be sorted. Linking the nodes
+		in order is O(n), instead of O(n log n) for inserting them one by one.
+		"""
+		assert not self.size, "extend only works on an empty list"
+
+		last = [self.head] * MAX_LEVELS # last node on every level
+		steps = [0] * MAX_LEVELS # position of that node
+		position = 0
+		for key in keys:
+			position += 1
+			levels = min(MAX_LEVELS, 1 - int(math.log(1.0 - random.random(), 2.0)))
+			node = Node(key, levels)
+			for level in xrange(levels):
+				last[level].next[level] = node
+				last[level].width[level] = position - steps[level]
+				last[level] = node
+				steps[level] = position
+
+		for level in xrange(MAX_LEVELS):
+			last[level].next[level] = self.tail
+			last[level].width[level] = position + 1 - steps[level]
+
+		self.size = position
+
+	def remove(self, key):
+		chain, _ = self.find(key)
+		node = chain[0].next[0]
+		if node is self.tail or node.key != key:
+			raise KeyError(key)
+
+		levels = len(node.next)
+		for level in xrange(levels):
+			previous = chain[level]
+			previous.width[level] += node.width[level] - 1
+			previous.next[level] = node.next[level]
+
+		for level in xrange(levels, MAX_LEVELS):
+			chain[level].width[level] -= 1
+
+		self.size -= 1
+
+	def index(self, key):
+		"""Returns the position of key, starting at 0. Raises KeyError if not found."""
+		chain, steps = self.find(key)
+		node = chain[0].next[0]
+		if node is self.tail or node.key != key:
+			raise KeyError(key)
+
+		return steps[0]
+
+	def first(self, count):
+		"""Returns the first count keys"""
+		keys = []
+		node = self.head.next[0]
+		while node is not self.tail and len(keys) < count:
+			keys.append(node.key)
+			node = node.next[0]
+		return keys
+
+
+class Leaderboard(object):
+	"""
+	Total points of every player on the server, ranked from best to worst.
+	Players with the same number of points are ordered by username.
+	"""
+	def __init__(self):
+		self.points  = {} # username -> total points
+		self.ranking = SkipList() # (-points, username)
+		self.changed = set() # usernames whose points changed since the last snapshot
+
+	def __len__(self):
+		return len(self.points)
+
+	def add(self, username, points):
+		"""Adds points to the total of username"""
+		old = self.points.get(username)
+		if old is not None:
+			if not points:
+				return
+			self.ranking.remove((-old, username))
+
+		total = (old or 0) + points
+		self.points[username] = total
+		self.ranking.insert((-total, username))
+		self.changed.add(username)
+
+	def load(self, points):
+		"""Sets the total points of every player, e.g. from a snapshot. The leaderboard must be empty."""
+		self.points = dict(points)
+		self.ranking.extend(sorted((-total, username) for username, total in self.points.iteritems()))
+
+	def add_scores(self, deltas):
+		"""Adds the points from a round. deltas is username -> points"""
+		for username, points in deltas.iteritems():
+			self.add(username, points)
+
+	def rank(self, username):
+		"""Returns the rank of username, starting at 1, or None if the player has no score."""
+		if username not in self.points:
+			return None
+
+		return self.ranking.index((-self.points[username], username)) + 1
+
+	def top(self, count):
+		"""Returns [(username, points)] for the count best players"""
+		return [(username, -points) for points, username in self.ranking.first(count)]
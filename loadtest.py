@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Load tests
+
+Runs games in this process against the real reactor, with simulated players
+instead of network clients, and reports how long rounds take.
+
+A large room with many players, answering at random during the first
+ANSWER_SPREAD seconds of every round:
+ python loadtest.py room [players] [rounds]
+
+The players connect to a server through its protocol, on in-memory
+transports, so everything they get goes through their sessions and outbound
+queues like it would on the network.
+
+For every round it reports the time from the last answer until every player
+has the result, how long it took to send the result to everybody, and the
+longest time the reactor was busy with one thing while the answers came in.
+If these stay the same from round to round, the room keeps up.
+
+Small games on a server where one client floods the server with tracks:
+ python loadtest.py flood [games] [rounds]
+
+The games play the given number of rounds in peace, then as many while the
+flooding client sends FLOOD_MESSAGES add_tracks messages in every iteration
+of the reactor, reconnecting whenever it is disconnected. It reports how
+late rounds start compared to the intermission timeout in both phases.
+Nothing is written to disk.
+
+Snapshots of a server with many games, each with MAX_PLAYERS players and
+USED_TRACKS used tracks:
+ python loadtest.py snapshot [games]
+
+After SETTLE_TIME seconds without snapshots, it takes a full snapshot, one
+where SNAPSHOT_CHANGED of the games have changed and one where nothing has,
+then restores a server from the snapshot and its journal. For every snapshot
+it reports the time spent in the reactor, the time until it was written, how
+much was written and the longest reactor lag meanwhile.
+
+Startup time of the server, the headless client and the GUI:
+ python loadtest.py startup [runs]
+
+Every import is timed in a new Python process, the given number of times,
+and the fastest time is reported together with the time it takes to start
+Python at all. It also checks that the headless client doesn't import
+Pygame or the audio helpers.
+
+"""
+from conf import *
+
+import server
+import snapshot
+
+import cPickle
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+# Players answer at a random time during the first ANSWER_SPREAD seconds of a round
+ANSWER_SPREAD = 2.0
+
+# Share of the players that answer correctly
+CORRECT_SHARE = 0.5
+
+# The reactor is checked for lag this often, in seconds
+HEARTBEAT = 0.01
+
+# add_tracks messages sent by the flooding client in every reactor iteration,
+# with TRACKS_PER_MESSAGE tracks each
+FLOOD_MESSAGES     = 20
+TRACKS_PER_MESSAGE = 50
+
+# Used tracks in every game, and the share of the games that change between
+# two snapshots
+USED_TRACKS      = 100
+SNAPSHOT_CHANGED = 0.1
+
+# Seconds to wait before the first snapshot
+SETTLE_TIME = 3
+
+# What to time in the startup test, and modules that only the GUI and the
+# music should import
+STARTUP_IMPORTS = (
+	(u"Server", 'server'),
+	(u"Headless client", 'client'),
+	(u"GUI", 'gui'),
+)
+HEAVY_MODULES = ('pygame', 'spotify.alsahelper', 'spotify.osshelper')
+
+IMPORT_TIMER = """
+import sys, time
+start = time.time()
+%s
+print time.time() - start
+print ' '.join(m for m in %r if m in sys.modules)
+"""
+
+
+class Heartbeat(object):
+	"""Measures how late the reactor is, i.e. how long it was busy with something else"""
+	def __init__(self):
+		self.lag = 0.0 # longest lag since reset
+		self.due = time.time() + HEARTBEAT
+		reactor.callLater(HEARTBEAT, self.beat)
+
+	def beat(self):
+		now = time.time()
+		self.lag = max(self.lag, now - self.due)
+		self.due = now + HEARTBEAT
+		reactor.callLater(HEARTBEAT, self.beat)
+
+	def reset(self):
+		lag, self.lag = self.lag, 0.0
+		return lag
+
+
+class PlayerTransport(proto_helpers.StringTransport):
+	"""Transport of a simulated client. Hands everything written to it to the player."""
+	def __init__(self, player):
+		proto_helpers.StringTransport.__init__(self)
+		self.player = player
+
+	def write(self, data):
+		self.player.received(data, time.time())
+
+
+class Player(object):
+	"""
+	Simulated client, connected to the server like a real one. Answers every
+	round, and asks for its score after a correct answer like the real client
+	does in large rooms.
+	
+	The player only reads what the server wrote to it in a later reactor
+	iteration, so the time it takes the server to send something is measured
+	without the time the simulated clients take to read it.
+	"""
+	def __init__(self, test, username):
+		self.test     = test
+		self.username = username
+		self.correct  = False
+		self.pending  = [] # (data, time it was written)
+
+		self.connection = test.factory.buildProtocol(None)
+		self.connection.makeConnection(PlayerTransport(self))
+		self.send({'action': 'connect', 'username': username})
+
+	def send(self, d):
+		self.connection.dataReceived(cPickle.dumps(d) + '\r\n')
+
+	def received(self, data, written):
+		if not self.pending:
+			reactor.callLater(0, self.read)
+		self.pending.append((data, written))
+
+	def read(self):
+		pending, self.pending = self.pending, []
+		for data, written in pending:
+			for line in data.split('\r\n'):
+				if line:
+					# Session frames are prefixed with their sequence number
+					self.handle(cPickle.loads(line.split(' ', 1)[1]), written)
+
+	def handle(self, d, written):
+		if d['action'] == 'start_round':
+			reactor.callLater(random.uniform(0, ANSWER_SPREAD), self.answer)
+		elif d['action'] == 'end_round':
+			self.test.result_received(self, written)
+			if self.correct:
+				self.send({'action': 'score'})
+			self.correct = False
+
+	def answer(self):
+		g = self.test.game
+		if not g.is_running:
+			return
+
+		answer = g.correct_answer
+		if random.random() >= CORRECT_SHARE:
+			answer = (answer + 1) % NUMBER_OF_ALTERNATIVES
+		self.correct = answer == g.correct_answer
+		self.send({'action': 'answer', 'answer': answer, 'time': time.time() - self.test.started})
+		self.test.last_answer = time.time()
+
+
+class RoomTest(object):
+	"""A single large room on a server, with the given number of players"""
+	def __init__(self, players, rounds):
+		self.rounds  = rounds
+		self.factory = protocol.ServerFactory()
+		self.factory.protocol = server.Receiver
+		self.factory.clients = []
+		self.factory.server = self.server = server.Server()
+		self.game    = self.server.start_game(large_room = True)
+		self.players = [Player(self, 'player%d' % i) for i in xrange(players)]
+		self.results = [] # (end latency, broadcast time, reactor lag) for every round
+
+		self.started     = None
+		self.ended       = None
+		self.last_answer = None
+		self.last_result = None
+		self.received    = 0
+
+		# Note when every round starts and ends
+		notify_clients = self.game.notify_clients
+		def notify(d):
+			if d['action'] == 'start_round':
+				self.round_started()
+			elif d['action'] == 'end_round':
+				self.ended = time.time()
+			notify_clients(d)
+		self.game.notify_clients = notify
+
+		self.game.add_tracks(None, {'tracks': [('spotify:track:%d' % i, 'Artist %d' % i, 'Title %d' % i) for i in xrange(100)]})
+		self.heartbeat = Heartbeat()
+
+	def round_started(self):
+		self.started = time.time()
+		self.last_answer = None
+		self.last_result = None
+		self.received = 0
+		self.heartbeat.reset()
+
+	def result_received(self, player, written):
+		"""player has read the result of the round, which was written to it at written"""
+		self.last_result = max(self.last_result, written)
+		self.received += 1
+		if self.received < len(self.players):
+			return
+
+		self.results.append((self.last_result - (self.last_answer or self.started), self.last_result - self.ended, self.heartbeat.reset()))
+		print u"Round %2d: result %6.1f ms after the last answer, sent in %6.1f ms, reactor lag %6.1f ms" % (
+			len(self.results), self.results[-1][0] * 1000, self.results[-1][1] * 1000, self.results[-1][2] * 1000)
+
+		if len(self.results) == self.rounds:
+			reactor.callLater(0, reactor.stop)
+
+	def report(self):
+		if not self.results:
+			return
+
+		for i, label in enumerate((u"Result after last answer", u"Sending the result", u"Reactor lag")):
+			values = [r[i] * 1000 for r in self.results]
+			print u"%-25s min %6.1f ms, mean %6.1f ms, max %6.1f ms" % (label, min(values), sum(values) / len(values), max(values))
+
+
+class GamePlayer(object):
+	"""Simulated client in a small game on a server"""
+	def __init__(self, test, username):
+		self.test     = test
+		self.username = username
+
+	def send(self, d):
+		self.send_frame(pickle.dumps(d), d['action'])
+
+	def send_frame(self, frame, kind):
+		if kind == 'start_round':
+			reactor.callLater(random.uniform(0, ANSWER_SPREAD), self.answer, time.time())
+		elif kind == 'end_round':
+			self.test.round_ended(self)
+
+	def answer(self, started):
+		g = self.test.server.games[self.test.server.clients[self]]
+		if g.is_running:
+			self.test.server.received_answer(self, {'answer': g.correct_answer, 'time': time.time() - started})
+
+
+class Flooder(object):
+	"""Client sending as many tracks as it can, through the admission control of the server"""
+	def __init__(self, factory):
+		self.factory     = factory
+		self.connection  = None
+		self.connections = 0
+		self.sent        = 0 # bytes
+		self.track       = 0
+
+	def connect(self):
+		self.connection = self.factory.buildProtocol(None)
+		self.connection.makeConnection(proto_helpers.StringTransport())
+		self.connection.dataReceived(pickle.dumps({'action': 'connect', 'username': 'flooder'}) + '\r\n')
+		self.connections += 1
+
+	def flood(self):
+		if not self.connection or self.connection.transport.disconnecting:
+			if self.connection:
+				self.connection.connectionLost(failure.Failure(Exception("Disconnected by the server")))
+			self.connect()
+
+		lines = []
+		for _ in xrange(FLOOD_MESSAGES):
+			tracks = [('spotify:track:flood%d' % (self.track + i), 'Flood', 'Flood') for i in xrange(TRACKS_PER_MESSAGE)]
+			self.track += TRACKS_PER_MESSAGE
+			lines.append(pickle.dumps({'action': 'add_tracks', 'tracks': tracks}))
+		data = '\r\n'.join(lines) + '\r\n'
+
+		self.sent += len(data)
+		self.connection.dataReceived(data)
+		self.connection.transport.clear()
+		reactor.callLater(0, self.flood)
+
+
+class FloodTest(object):
+	"""Small games that play rounds in peace, then while a client floods the server"""
+	def __init__(self, games, rounds):
+		self.rounds = rounds
+		self.factory = protocol.ServerFactory()
+		self.factory.protocol = server.Receiver
+		self.factory.clients = []
+		self.factory.server = self.server = server.Server()
+
+		self.players = []
+		for i in xrange(games * MAX_PLAYERS):
+			player = GamePlayer(self, 'player%d' % i)
+			self.server.add_client(player, {'username': player.username})
+			self.players.append(player)
+
+		self.games = self.server.games[:]
+		for g in self.games:
+			g.add_tracks(None, {'tracks': [('spotify:track:%d' % i, 'Artist %d' % i, 'Title %d' % i) for i in xrange(100)]})
+			self.watch(g)
+
+		self.ended   = {} # game -> time its last round ended
+		self.played  = dict((g, 0) for g in self.games) # game -> rounds played
+		self.lags    = {'quiet': [], 'flood': []} # how late rounds started, in seconds
+		self.reactor_lags = {'quiet': 0.0, 'flood': 0.0}
+		self.phase   = 'quiet'
+		self.flooder = None
+
+		self.heartbeat = Heartbeat()
+
+	def watch(self, g):
+		"""Notes when rounds of g start"""
+		notify_clients = g.notify_clients
+		def notify(d):
+			if d['action'] == 'start_round' and g in self.ended:
+				self.lags[self.phase].append(time.time() - self.ended.pop(g) - INTERMISSION_TIMEOUT)
+			notify_clients(d)
+		g.notify_clients = notify
+
+	def round_ended(self, player):
+		g = self.server.games[self.server.clients[player]]
+		if g in self.ended:
+			# Already counted for another player of this game
+			return
+
+		self.ended[g] = time.time()
+		self.played[g] += 1
+		if min(self.played.itervalues()) < self.rounds * (2 if self.phase == 'flood' else 1):
+			return
+
+		self.reactor_lags[self.phase] = self.heartbeat.reset()
+		if self.phase == 'quiet':
+			print u"Flooding..."
+			self.phase = 'flood'
+			self.flooder = Flooder(self.factory)
+			self.flooder.flood()
+		else:
+			reactor.callLater(0, reactor.stop)
+
+	def report(self):
+		for phase in ('quiet', 'flood'):
+			values = [lag * 1000 for lag in self.lags[phase]] or [0]
+			print u"%s: %d rounds started %.1f ms late on average, at most %.1f ms. Reactor lag at most %.1f ms." % (
+				phase.capitalize(), len(self.lags[phase]), sum(values) / len(values), max(values), self.reactor_lags[phase] * 1000)
+
+		if self.flooder:
+			flooded = [g for g in self.server.games if g not in self.games]
+			print u"The flooding client sent %.1f MB in %d connections, %d tracks were added." % (
+				self.flooder.sent / 1024.0 / 1024.0, self.flooder.connections, sum(len(g.all_tracks) for g in flooded))
+
+
+def flood(games = 10, rounds = 5):
+	# Keep everything in memory
+	server.SNAPSHOT_PATH = server.CATALOGUE_PATH = server.EVENT_LOG_DIR = None
+
+	print u"%d games of %d players, %d rounds in peace and %d while one client floods the server." % (games, MAX_PLAYERS, rounds, rounds)
+	test = FloodTest(games, rounds)
+	reactor.run()
+	test.report()
+
+
+class SnapshotTest(object):
+	"""Snapshots and restores a server with many games"""
+	def __init__(self, games):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'server.snapshot')
+
+		start = time.time()
+		self.server = server.Server()
+		for i in xrange(games):
+			g = self.server.start_game()
+			g.stop_callbacks() # no intermissions, only snapshots should keep the reactor busy
+			g.round = random.randint(1, 1000)
+			g.used_tracks = [('spotify:track:%022d' % random.getrandbits(64), 'Artist %d' % j, 'Title %d' % j) for j in xrange(USED_TRACKS)]
+			for j in xrange(MAX_PLAYERS):
+				username = 'player%d' % (i * MAX_PLAYERS + j)
+				g.users[object()] = username
+				g.standings[username] = random.randint(0, 10000)
+				self.server.leaderboard.add(username, g.standings[username])
+		print u"Created %d games in %.1f s." % (games, time.time() - start)
+
+		self.snapshots = snapshot.Snapshotter(self.server, self.path)
+		self.heartbeat = Heartbeat()
+
+	def take(self, label):
+		"""Takes a snapshot, returns a Deferred that fires when it is written"""
+		self.heartbeat.reset()
+		start = time.time()
+		if not self.snapshots.take():
+			print u"%-9s nothing to write, %.1f ms in the reactor." % (label, (time.time() - start) * 1000)
+			return defer.succeed(None)
+
+		in_reactor = time.time() - start
+		d = defer.Deferred()
+		def wait():
+			if self.snapshots.child:
+				reactor.callLater(HEARTBEAT, wait)
+				return
+
+			print u"%-9s %.1f ms in the reactor, written after %.1f ms, %.1f MB, reactor lag at most %.1f ms." % (
+				label, in_reactor * 1000, (time.time() - start) * 1000, self.snapshots.written / 1024.0 / 1024.0,
+				self.heartbeat.reset() * 1000)
+			d.callback(None)
+		wait()
+		return d
+
+	def run(self):
+		# Let the reactor settle after creating all the games
+		self.heartbeat.reset()
+		d = task.deferLater(reactor, SETTLE_TIME, self.idle)
+		d.addCallback(lambda _: self.take(u"Full:"))
+		d.addCallback(lambda _: self.change())
+		d.addCallback(lambda _: self.take(u"Changed:"))
+		d.addCallback(lambda _: self.take(u"Same:"))
+		d.addCallback(lambda _: self.restore())
+		d.addBoth(lambda _: reactor.stop())
+
+	def idle(self):
+		print u"%-9s reactor lag at most %.1f ms without snapshots." % (u"Idle:", self.heartbeat.reset() * 1000)
+
+	def change(self):
+		"""Plays a round in some of the games"""
+		for g in random.sample(self.server.games, int(len(self.server.games) * SNAPSHOT_CHANGED)):
+			g.round += 1
+			g.used_tracks.append(('spotify:track:%022d' % random.getrandbits(64), 'Artist', 'Title'))
+			for username in g.standings:
+				g.standings[username] += 1
+				self.server.leaderboard.add(username, 1)
+			g.dirty = True
+
+		# Let the heartbeat catch up, so the lag of the next snapshot is its own
+		return task.deferLater(reactor, HEARTBEAT * 2, lambda: None)
+
+	def restore(self):
+		server.SNAPSHOT_PATH = self.path
+		start = time.time()
+		restored = server.Server()
+		print u"Restored %d games and %d players in %.1f ms." % (
+			len(restored.games), len(restored.leaderboard), (time.time() - start) * 1000)
+
+	def close(self):
+		shutil.rmtree(self.directory)
+
+
+def snapshots(games = 10000):
+	server.SNAPSHOT_PATH = server.CATALOGUE_PATH = server.EVENT_LOG_DIR = None
+
+	test = SnapshotTest(games)
+	reactor.callWhenRunning(test.run)
+	reactor.run()
+	test.close()
+
+
+def room(players = 1000, rounds = 10):
+	# Keep everything in memory
+	server.SNAPSHOT_PATH = server.CATALOGUE_PATH = server.EVENT_LOG_DIR = None
+
+	print u"%d players in one large room, %d rounds." % (players, rounds)
+	test = RoomTest(players, rounds)
+	reactor.run()
+	test.report()
+
+
+def time_import(statement):
+	"""Returns (seconds, heavy modules imported) for statement in a new process, or raises RuntimeError"""
+	process = subprocess.Popen([sys.executable, '-c', IMPORT_TIMER % (statement, HEAVY_MODULES)],
+		cwd = os.path.dirname(os.path.abspath(__file__)), stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+	out, err = process.communicate()
+	if process.returncode:
+		raise RuntimeError(err.strip().splitlines()[-1])
+
+	seconds, heavy = out.split('\n', 1)
+	return float(seconds), heavy.split()
+
+
+def startup(runs = 5):
+	start = time.time()
+	for _ in xrange(runs):
+		subprocess.call([sys.executable, '-c', 'pass'])
+	print u"%-16s %7.1f ms" % (u"Python itself:", (time.time() - start) / runs * 1000)
+
+	for label, module in STARTUP_IMPORTS:
+		try:
+			results = [time_import('import %s' % module) for _ in xrange(runs)]
+		except RuntimeError, e:
+			print u"%-16s not available, %s" % (label + u":", e)
+			continue
+
+		heavy = results[0][1]
+		print u"%-16s %7.1f ms, imports %s" % (label + u":", min(r[0] for r in results) * 1000,
+			', '.join(heavy) if heavy else u"none of " + ', '.join(HEAVY_MODULES))
+
+
+if __name__ == '__main__':
+	tests = {'room': room, 'flood': flood, 'snapshot': snapshots, 'startup': startup}
+	if len(sys.argv) < 2 or sys.argv[1] not in tests:
+		print >> sys.stderr, u"""
+Usage:
+ python loadtest.py room [players] [rounds]
+ python loadtest.py flood [games] [rounds]
+ python loadtest.py snapshot [games]
+ python loadtest.py startup [runs]
+"""
+		sys.exit(1)
+
+	tests[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
@@ -0,0 +1,159 @@
+"""
+Outbound message queues
+
+Messages to a connection are not written right away. They are queued and
+written together, once per reactor iteration, in a single write. Every queue
+is registered as a push producer on its transport, so when a client can't keep
+up, Twisted pauses the queue and messages wait here instead of in the
+transport.
+
+While waiting, a message is replaced by a newer message of the same kind if
+only the newest one matters, such as intermission updates. A client whose
+queue grows beyond MAX_OUTBOUND_BYTES is disconnected.
+"""
+from conf import *
+
+import collections
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class OutboundQueue(object):
+	"""
+	Queue of pickled messages to a LineReceiver.
+	"""
+	# Totals for all queues, reported in the server metrics
+	coalesced    = 0
+	disconnected = 0
+
+	def __init__(self, connection, coalesce = COALESCED_MESSAGES, bulk = False):
+		self.connection = connection
+		self.coalesce   = coalesce # kinds where only the newest message matters. None means all kinds.
+		self.bulk       = bulk     # bulk queues are flushed after all other queues, see Flusher
+
+		self.frames = collections.deque() # [kind, frame, prefix], frame is None if it was replaced
+		self.latest = {} # kind -> entry in self.frames, for coalesced kinds
+		self.size   = 0  # bytes waiting to be written
+
+		self.paused = False
+		self.closed = False
+
+		connection.transport.registerProducer(self, True)
+
+	def push(self, kind, frame, prefix = ''):
+		"""
+		Queues a pickled frame of the given kind, to be written right after
+		prefix. The same frame is often queued for many connections with a
+		different prefix each, so they are only joined when written.
+		"""
+		if self.closed:
+			return
+
+		entry = [kind, frame, prefix]
+		if self.coalesce is None or kind in self.coalesce:
+			old = self.latest.get(kind)
+			if old is not None:
+				self.size -= len(old[1]) + len(old[2])
+				old[1] = None
+				OutboundQueue.coalesced += 1
+			self.latest[kind] = entry
+
+		self.frames.append(entry)
+		self.size += len(frame) + len(prefix)
+
+		if self.size > MAX_OUTBOUND_BYTES:
+			self.disconnect()
+			return
+
+		flusher.schedule(self)
+
+	def flush(self):
+		"""Writes everything in the queue in a single write"""
+		if self.paused or self.closed:
+			return
+
+		delimiter = self.connection.delimiter
+		data = []
+		for kind, frame, prefix in self.frames:
+			if frame is not None:
+				if prefix:
+					data.append(prefix)
+				data.append(frame)
+				data.append(delimiter)
+
+		self.frames.clear()
+		self.latest.clear()
+		self.size = 0
+
+		if data:
+			self.connection.transport.write(''.join(data))
+
+	def disconnect(self):
+		log.msg("Disconnecting %s, %d bytes waiting to be sent." % (self.connection.transport.getPeer(), self.size))
+		OutboundQueue.disconnected += 1
+		self.stopProducing()
+
+		transport = self.connection.transport
+		if hasattr(transport, 'abortConnection'):
+			transport.abortConnection()
+		else:
+			transport.loseConnection()
+
+	def pauseProducing(self):
+		self.paused = True
+
+	def resumeProducing(self):
+		self.paused = False
+		if self.frames:
+			flusher.schedule(self)
+
+	def stopProducing(self):
+		self.closed = True
+		self.frames.clear()
+		self.latest.clear()
+		self.size = 0
+
+
+class Flusher(object):
+	"""
+	Flushes queues with new messages in the next reactor iteration. All
+	normal queues are flushed in every iteration, but only FANOUT_BATCH bulk
+	queues, so spectators never hold up the players.
+	"""
+	def __init__(self):
+		self.queues    = []
+		self.bulk      = collections.deque()
+		self.scheduled = set()
+		self.call      = None
+
+	def schedule(self, queue):
+		if queue in self.scheduled:
+			return
+
+		self.scheduled.add(queue)
+		if queue.bulk:
+			self.bulk.append(queue)
+		else:
+			self.queues.append(queue)
+
+		if not self.call:
+			self.call = reactor.callLater(0, self.run)
+
+	def run(self):
+		self.call = None
+
+		queues, self.queues = self.queues, []
+		for queue in queues:
+			self.scheduled.discard(queue)
+			queue.flush()
+
+		for _ in xrange(min(FANOUT_BATCH, len(self.bulk))):
+			queue = self.bulk.popleft()
+			self.scheduled.discard(queue)
+			queue.flush()
+
+		if self.queues or self.bulk:
+			self.call = reactor.callLater(0, self.run)
+
+flusher = Flusher()
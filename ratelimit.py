@@ -0,0 +1,131 @@
+"""
+Admission control
+
+Every connection and every game has a budget: a number of messages and a
+number of units (bytes for a connection, tracks for a game) per second. Work
+that is over budget is not rejected, but put in the ingestion queue and done
+in the background when the budget allows. The ingestion queue does a bounded
+amount of work in every run, so a client flooding the server can't stall the
+rounds of other games.
+"""
+from conf import *
+
+import collections
+import time
+
+from twisted.internet import reactor
+
+
+class TokenBucket(object):
+	"""
+	Holds up to capacity tokens and is refilled with rate tokens per second.
+	"""
+	def __init__(self, rate, capacity):
+		self.rate     = float(rate)
+		self.capacity = float(capacity)
+		self.tokens   = float(capacity)
+		self.updated  = time.time()
+
+	def refill(self):
+		now = time.time()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def available(self, amount):
+		"""
+		True if amount tokens are available. Amounts larger than the capacity
+		are allowed when the bucket is full, otherwise they would never be.
+		"""
+		self.refill()
+		return self.tokens >= min(amount, self.capacity)
+
+	def take(self, amount):
+		self.tokens -= min(amount, self.capacity)
+
+
+class Budget(object):
+	"""Message rate and unit rate, as two token buckets"""
+	def __init__(self, message_rate, message_burst, unit_rate, unit_burst):
+		self.messages = TokenBucket(message_rate, message_burst)
+		self.units    = TokenBucket(unit_rate, unit_burst)
+
+	def consume(self, units):
+		"""Takes one message and the given units from the budget. Returns False if over budget."""
+		if not self.messages.available(1) or not self.units.available(units):
+			return False
+
+		self.messages.take(1)
+		self.units.take(units)
+		return True
+
+
+class IngestionQueue(object):
+	"""
+	Work that was over budget. Each budget has its own queue, and the queues
+	are served round robin, in the order the work was deferred.
+	"""
+	def __init__(self):
+		self.queues = collections.OrderedDict() # budget -> deque of (units, function, args)
+		self.units  = {} # budget -> units waiting
+		self.call   = None # pending run, only while there is deferred work
+
+	def pending(self, budget):
+		"""True if budget has deferred work. New work must wait behind it."""
+		return budget in self.queues
+
+	def waiting(self, budget):
+		"""Returns the number of units of deferred work for budget"""
+		return self.units.get(budget, 0)
+
+	def defer(self, budget, units, function, *args):
+		"""Calls function(*args) once budget has room for units"""
+		if budget not in self.queues:
+			self.queues[budget] = collections.deque()
+			self.units[budget] = 0
+
+		self.queues[budget].append((units, function, args))
+		self.units[budget] += units
+		self.schedule()
+
+	def schedule(self):
+		if not self.call:
+			self.call = reactor.callLater(INGESTION_INTERVAL, self.run)
+
+	def discard(self, budget):
+		"""Drops all deferred work for budget"""
+		self.queues.pop(budget, None)
+		self.units.pop(budget, None)
+
+	def run(self):
+		"""Does at most INGESTION_BATCH pieces of work, then waits INGESTION_INTERVAL if there is more"""
+		self.call = None
+		done = 0
+		progress = True
+		while self.queues and progress and done < INGESTION_BATCH:
+			progress = False
+			for budget in self.queues.keys():
+				queue = self.queues.get(budget)
+				if not queue:
+					# Discarded by work done earlier in this run
+					continue
+
+				units, function, args = queue[0]
+				if not budget.consume(units):
+					continue
+
+				queue.popleft()
+				self.units[budget] -= units
+				if queue:
+					# Move to the back of the line
+					self.queues[budget] = self.queues.pop(budget)
+				else:
+					self.discard(budget)
+
+				function(*args)
+				progress = True
+				done += 1
+				if done >= INGESTION_BATCH:
+					break
+
+		if self.queues:
+			self.schedule()
@@ -13,6 +13,9 @@ serves it's purpose.
 All clients that join will share all their tracks. The tracks used in the game
 will be picked randomly from these tracks.
 
+Clients may also join as spectators and watch a game without playing. See
+fanout.py for how to serve many spectators from a separate process.
+
 Dependencies:
  * Twisted
 
@@ -21,7 +24,14 @@ Usage:
 
 """
 
+import catalogue
+import eventlog
 import game
+import leaderboard
+import outbound
+import ratelimit
+import session
+import snapshot
 from conf import *
 
 import pickle
@@ -40,15 +50,118 @@ class Server(object):
 	The Master is responsible for:
 	 * Starting new Games when needed
 	 * Removing old Games no longer in use
+	 * Keeping the leaderboard of all players across all games
 	"""
 	def __init__(self):
 		self.games = []
 		self.clients = {} # client -> index into games list
+		self.sessions = {} # token -> session.Session
+		self.spectators = {} # spectating client -> index into games list
+		self.leaderboard = leaderboard.Leaderboard()
+		self.ingestion = ratelimit.IngestionQueue()
+		
+		self.events = None
+		if EVENT_LOG_DIR:
+			self.events = eventlog.EventLog(EVENT_LOG_DIR)
+		
+		self.catalogue = None
+		if CATALOGUE_PATH:
+			self.catalogue = catalogue.Catalogue(CATALOGUE_PATH)
+		
+		self.reserved = {} # username -> index into games list, for players from before a restart
+		self.snapshots = None
+		if SNAPSHOT_PATH:
+			self.snapshots = snapshot.Snapshotter(self, SNAPSHOT_PATH)
+			self.restore()
+			self.snapshots.start()
+	
+	def restore(self):
+		"""Restores games and the leaderboard from the last snapshot"""
+		state = self.snapshots.load()
+		if not state:
+			return
+		
+		games, points = state
+		self.leaderboard.load(points)
+		
+		for game_state in games:
+			restored = self.start_game(game_state['large_room'])
+			restored.restore(game_state)
+			for username in game_state['roster']:
+				self.reserved[username] = restored.id
+		
+		# Players have RESTORE_GRACE seconds to reconnect
+		reactor.callLater(RESTORE_GRACE, self.expire_reserved)
+	
+	def expire_reserved(self):
+		"""Gives up the seats and scores of players that did not reconnect after a restart"""
+		for g in self.games:
+			g.expire_reserved()
+		self.reserved = {}
+	
+	def close(self):
+		"""Called when the server shuts down"""
+		if self.snapshots:
+			self.snapshots.save()
+		if self.events:
+			self.events.close()
+		if self.catalogue:
+			self.catalogue.close()
+	
+	def connect(self, connection, args):
+		"""
+		A new player. Starts a session for the player and adds the session
+		to a game. Games only ever see the session, see session.py.
+		"""
+		if connection.session:
+			return
+		
+		# Spectators may decide to play
+		self.stop_spectating(connection)
+		
+		player = session.Session(args['username'])
+		self.sessions[player.token] = player
+		connection.session = player
+		player.attach(connection)
+		player.send({'action': 'session', 'token': player.token, 'grace': RESUME_GRACE})
+		
+		self.add_client(player, args)
+	
+	def resume(self, connection, args):
+		"""A player reconnected and wants to continue the session with the given token."""
+		player = self.sessions.get(args['token'])
+		if not player:
+			connection.send({'action': 'resume_failed'})
+			return
+		
+		self.stop_spectating(connection)
+		
+		if player.connection and player.connection is not connection:
+			# The old connection hasn't noticed that it is gone yet
+			old, old.session = player.connection, None
+			old.transport.loseConnection()
+		
+		connection.session = player
+		complete = player.attach(connection, args['seq'])
+		player.send({'action': 'resumed', 'complete': complete})
+		log.msg("Resumed %s from #%d%s." % (player, args['seq'], '' if complete else ', some frames were lost'))
+	
+	def session_expired(self, player):
+		"""The player did not come back in time. Give up the seat."""
+		del self.sessions[player.token]
+		if player in self.clients:
+			self.games[self.clients[player]].remove_client(player)
+			del self.clients[player]
 	
 	def add_client(self, client, args):
 		"""
 		Add client to an existing game or create a new game.
+		Players from before a restart go back to the game they were in.
 		"""
+		i = self.reserved.pop(args['username'], None)
+		if i is not None and self.join_game(self.games[i], client, args) != -1:
+			return
+		
 		available_games = filter(lambda g: not g.is_full(), self.games)
 		
 		if available_games:
@@ -60,12 +173,42 @@ class Server(object):
 		
 		else:
 			# If all games are full, start a new game and try the process all over again
-			new_game = game.Game(self.get_next_game_id())
-			self.games.append(new_game)
-			log.msg("%s: Started new game." % new_game)
+			self.start_game()
 
 			return self.add_client(client, args)
 	
+	def start_game(self, large_room = LARGE_ROOMS):
+		new_game = game.Game(self.get_next_game_id(), self.leaderboard, large_room, self.events)
+		self.games.append(new_game)
+		log.msg("%s: Started new game." % new_game)
+		
+		return new_game
+	
+	def add_spectator(self, client, args):
+		"""
+		Let client watch a game without playing. Spectates the given game, or
+		the newest game if none is given. Players can't spectate, their
+		messages would be held back with those of the spectators.
+		"""
+		if client.session:
+			log.msg("%s tried to spectate while playing." % client.session)
+			return
+		
+		self.stop_spectating(client)
+		
+		i = args.get('game')
+		if i is None or not 0 <= i < len(self.games):
+			if not self.games:
+				self.start_game()
+			i = len(self.games) - 1
+		
+		self.games[i].spectators.subscribe(client)
+		self.spectators[client] = i
+	
+	def stop_spectating(self, client):
+		if client in self.spectators:
+			self.games[self.spectators.pop(client)].spectators.unsubscribe(client)
+	
 	def join_game(self, game, client, args):
 		"""Join client to game. Returns False if it was not possible to join, otherwise the id of the game."""
 		if not game.add_client(client, args):
@@ -75,13 +218,48 @@ class Server(object):
 		i = self.games.index(game)
 		self.clients[client] = i
 		
+		# Add the tracks this player has contributed before, so the game can
+		# start without waiting for the client to upload them again
+		if self.catalogue:
+			self.catalogue.tracks_for(args['username']).addCallback(self.seed_game, game, client)
+		
 		return i
 	
+	def seed_game(self, tracks, game, client):
+		"""Called with the tracks a client has contributed before it joined game"""
+		if not tracks:
+			return
+		
+		game.seed_tracks(tracks)
+		
+		# The client doesn't have to upload these again. Acknowledge them in
+		# batches, a single message would be longer than a line may be.
+		if self.clients.get(client) == self.games.index(game):
+			for i in xrange(0, len(tracks), TRACKS_PER_ACKNOWLEDGEMENT):
+				client.send({
+					'action': 'tracks_added',
+					'catalogue': game.id,
+					'uris': [t[0] for t in tracks[i:i + TRACKS_PER_ACKNOWLEDGEMENT]]
+				})
+	
 	def get_next_game_id(self):
 		return len(self.games)
 	
 	def client_disconnected(self, client):
-		"""Client disconnected for some reason. Remove client from the game it was in."""
+		"""
+		Client disconnected for some reason. Players keep their seat for a
+		while in case they come back, others are removed right away.
+		"""
+		self.stop_spectating(client)
+		
+		if client.session:
+			if client.session.connection is client:
+				client.session.detach(self.session_expired)
+			return
+		
+		if client not in self.clients:
+			return
+		
 		game = self.games[self.clients[client]]
 		game.remove_client(client)
 		del self.clients[client]
@@ -93,27 +271,101 @@ class Server(object):
 		game = self.games[self.clients[client]]
 		game.received_answer(client, args)
 	
+	def score_requested(self, client, args):
+		"""Called when the client asks for its score, used in large rooms"""
+		game = self.games[self.clients[client]]
+		game.score_requested(client)
+	
 	def add_tracks(self, client, args):
 		"""
 		Called from the client when Spotify starts loading tracks.
 		The tracks should be added to the game specific list of tracks.
+		
+		The client is told which tracks are now in the catalogue of its game,
+		so it never has to send them again.
+		
+		If the game has received too many tracks lately, the tracks are added
+		later by the ingestion queue.
 		"""
+		game = self.games[self.clients[client]]
+		tracks = len(args['tracks'])
+		if self.ingestion.pending(game.budget) or not game.budget.consume(tracks):
+			self.ingestion.defer(game.budget, tracks, self.ingest_tracks, client, args)
+			return
+		
+		self.ingest_tracks(client, args)
+	
+	def ingest_tracks(self, client, args):
+		if client not in self.clients:
+			# Left before we got around to it
+			return
+		
 		game = self.games[self.clients[client]]
 		game.add_tracks(client, args)
+		if self.catalogue:
+			self.catalogue.add(game.users[client], args['tracks'])
+		
+		client.send({
+			'action': 'tracks_added',
+			'catalogue': game.id,
+			'uris': [t[0] for t in args['tracks']]
+		})
 	
+	def leaderboard_requested(self, client, args):
+		"""
+		Sends the best players on the server to the client, together with
+		the rank of the player using the client.
+		"""
+		count = min(args.get('count', LEADERBOARD_SIZE), LEADERBOARD_SIZE)
+		
+		username = None
+		if client in self.clients:
+			username = self.games[self.clients[client]].users.get(client)
+		
+		client.send({
+			'action': 'leaderboard',
+			'top': self.leaderboard.top(count),
+			'rank': self.leaderboard.rank(username),
+			'points': self.leaderboard.points.get(username, 0),
+			'players': len(self.leaderboard)
+		})
 			
 class Receiver(basic.LineReceiver):
+	session = None # set when the client has connected as a player
+	
 	def connectionMade(self):
+		self.outbound = outbound.OutboundQueue(self)
+		self.budget = ratelimit.Budget(CONNECTION_MESSAGE_RATE, CONNECTION_MESSAGE_BURST, CONNECTION_BYTE_RATE, CONNECTION_BYTE_BURST)
 		self.factory.clients.append(self)
 
 	def connectionLost(self, reason):
+		self.factory.server.ingestion.discard(self.budget)
 		self.factory.clients.remove(self)
 		self.factory.server.client_disconnected(self)
 	
 	def send(self, d):
-		return self.sendLine(pickle.dumps(d))
+		return self.send_frame(pickle.dumps(d), d['action'])
+	
+	def send_frame(self, frame, kind, prefix = ''):
+		"""Queues an already pickled message of the given kind, to be sent after prefix"""
+		self.outbound.push(kind, frame, prefix)
 	
 	def lineReceived(self, line):
+		"""Handles line now if the client is within budget, otherwise later."""
+		ingestion = self.factory.server.ingestion
+		if ingestion.pending(self.budget) or not self.budget.consume(len(line)):
+			if ingestion.waiting(self.budget) + len(line) > MAX_DEFERRED_BYTES:
+				log.msg("Disconnecting %s, sending too much." % self.transport.getPeer())
+				ingestion.discard(self.budget)
+				self.transport.loseConnection()
+				return
+			
+			ingestion.defer(self.budget, len(line), self.process_line, line)
+			return
+		
+		self.process_line(line)
+	
+	def process_line(self, line):
 		args = pickle.loads(line)
 		action = args.pop('action')
 		
@@ -121,20 +373,45 @@ class Receiver(basic.LineReceiver):
 		
 	def handle_client_command(self, action, args):
 		# TODO: Use deferreds
+		# Players are known to the games by their session
+		client = self.session or self
+		
 		# Client is connecting for the first time.
 		# Add client to existing or new game.
 		if action == 'connect':
-			self.factory.server.add_client(self, args)
+			self.factory.server.connect(self, args)
+		
+		# Client lost the connection and is back
+		elif action == 'resume':
+			self.factory.server.resume(self, args)
 		
 		# Client is answering the quiz
 		elif action == 'answer':
-			self.factory.server.received_answer(self, args)
+			self.factory.server.received_answer(client, args)
 		
 		elif action == 'add_tracks':
-			self.factory.server.add_tracks(self, args)
+			self.factory.server.add_tracks(client, args)
+		
+		elif action == 'spectate':
+			self.factory.server.add_spectator(self, args)
+		
+		elif action == 'score':
+			self.factory.server.score_requested(client, args)
+		
+		elif action == 'leaderboard':
+			self.factory.server.leaderboard_requested(client, args)
 
 		return True
 
+
+def report_metrics(factory):
+	"""Logs the state of the outbound queues every METRICS_INTERVAL seconds"""
+	sizes = [c.outbound.size for c in factory.clients]
+	log.msg("Outbound: %d connections, %d bytes queued, largest queue %d bytes, %d messages coalesced, %d clients disconnected" % (
+		len(sizes), sum(sizes), max(sizes or [0]), outbound.OutboundQueue.coalesced, outbound.OutboundQueue.disconnected))
+	
+	reactor.callLater(METRICS_INTERVAL, report_metrics, factory)
+
 if __name__ == '__main__':
 	log.startLogging(sys.stdout)
 	
@@ -152,5 +429,7 @@ Usage:
 	factory.server = Server()
 	
 	reactor.listenTCP(int(sys.argv[1]), factory)
+	reactor.callLater(METRICS_INTERVAL, report_metrics, factory)
+	reactor.addSystemEventTrigger('before', 'shutdown', factory.server.close)
 	reactor.run()
 	
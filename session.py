@@ -0,0 +1,72 @@
+"""
+Resumable player sessions
+
+When a player connects, the server creates a session and gives the client
+its token. Games see the session, not the connection, so when the
+connection drops the player keeps their seat and score for RESUME_GRACE
+seconds. Every frame sent to the player gets a sequence number and the last
+REPLAY_BUFFER_SIZE frames are kept. A client that reconnects in time resumes
+the session with its token and the last sequence number it received, and
+gets only the frames it missed.
+
+Frames sent in a session are prefixed with the sequence number and a space:
+ 17 <pickled message>
+"""
+from conf import *
+
+import collections
+import os
+import pickle
+
+from twisted.internet import reactor
+
+
+def new_token():
+	return os.urandom(16).encode('hex')
+
+
+class Session(object):
+	def __init__(self, username):
+		self.token      = new_token()
+		self.username   = username
+		self.connection = None
+		self.seq        = 0 # sequence number of the last frame sent
+		self.frames     = collections.deque(maxlen = REPLAY_BUFFER_SIZE) # (seq, frame, kind)
+		self.expiry     = None # pending call ending the session, while disconnected
+
+	def __str__(self):
+		return "session of %s" % self.username
+
+	def send(self, d):
+		return self.send_frame(pickle.dumps(d), d['action'])
+
+	def send_frame(self, frame, kind):
+		"""Numbers and keeps the frame, and sends it if we are connected"""
+		self.seq += 1
+		self.frames.append((self.seq, frame, kind))
+		if self.connection:
+			# The frame is shared with the other players, don't copy it
+			self.connection.send_frame(frame, kind, '%d ' % self.seq)
+
+	def attach(self, connection, seq = 0):
+		"""
+		Uses connection for this session from now on, and sends the frames
+		after seq that the client has not received. Returns False if some of
+		them are no longer in the replay buffer.
+		"""
+		if self.expiry and self.expiry.active():
+			self.expiry.cancel()
+		self.expiry = None
+
+		self.connection = connection
+
+		complete = not self.frames or self.frames[0][0] <= seq + 1
+		for frame_seq, frame, kind in self.frames:
+			if frame_seq > seq:
+				connection.send_frame(frame, kind, '%d ' % frame_seq)
+		return complete
+
+	def detach(self, expired):
+		"""The connection was lost. Calls expired(self) if it is not resumed in time."""
+		self.connection = None
+		self.expiry = reactor.callLater(RESUME_GRACE, expired, self)
@@ -0,0 +1,308 @@
+"""
+Server snapshots
+
+The state of every game (roster, standings, used tracks and round number) and
+the leaderboard is saved to disk every SNAPSHOT_INTERVAL seconds and restored
+when the server starts again.
+
+Snapshots are incremental. A full snapshot of every game and the leaderboard
+is written to the snapshot file. After that, only the games and the players
+in the leaderboard that have changed since the last snapshot are written, as
+a record appended to a journal next to it (the snapshot file with .journal
+appended). When the journal grows larger than SNAPSHOT_COMPACTION times the
+full snapshot, a new full snapshot is written instead and the journal
+starts over. A restore loads the full snapshot and applies the records in
+the journal on top of it.
+
+Every journal record is tagged with the time of the full snapshot it
+belongs to, so records left from before a full snapshot are never applied
+to it.
+
+Snapshots are pickled and written by a child process, forked from the
+server. The child gets a copy-on-write copy of the server as it was when it
+was forked, so the reactor only pays for finding what changed and the fork,
+and carries on while the child works. Where fork is not available, the
+snapshot is written in the reactor.
+
+A full snapshot is written to a temporary file that replaces the old one
+when it is complete, so a crash while writing leaves the previous snapshot
+intact. If a snapshot can't be written, or the journal is damaged, the next
+snapshot is a full one.
+"""
+from conf import *
+
+import cPickle
+import gc
+import os
+import tempfile
+import time
+
+from twisted.internet import reactor
+from twisted.python import log
+
+VERSION = 3
+
+# Seconds between each check whether the child has finished writing
+REAP_INTERVAL = 0.1
+
+
+def write(path, snapshot):
+	"""Pickles snapshot to path, atomically"""
+	fd, tmp = tempfile.mkstemp(prefix = os.path.basename(path) + '.', dir = os.path.dirname(path) or '.')
+	f = os.fdopen(fd, 'wb')
+	try:
+		cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+		f.flush()
+		os.fsync(f.fileno())
+	finally:
+		f.close()
+	os.rename(tmp, path)
+
+
+def append(path, record):
+	"""Appends record to the journal at path. Records are prefixed with their length."""
+	data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+	f = open(path, 'ab')
+	try:
+		f.write('%d\n' % len(data))
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+	finally:
+		f.close()
+
+
+def records(f):
+	"""
+	Yields the records in the journal f. Raises ValueError if the journal
+	ends with a record that was not written completely.
+	"""
+	while True:
+		line = f.readline()
+		if not line:
+			return
+		if not line.endswith('\n'):
+			raise ValueError("Incomplete record length")
+
+		length = int(line)
+		data = f.read(length)
+		if len(data) < length:
+			raise ValueError("Incomplete record")
+		yield cPickle.loads(data)
+
+
+def size(path):
+	"""Size of the file at path, 0 if it doesn't exist"""
+	try:
+		return os.path.getsize(path)
+	except OSError:
+		return 0
+
+
+class Snapshotter(object):
+	def __init__(self, server, path):
+		self.server  = server
+		self.path    = path
+		self.journal = path + '.journal'
+		self.base    = None # time of the full snapshot on disk, journal records belong to it
+		self.child   = None # pid of the process writing a snapshot
+		self.started = None # time the snapshot being written was taken
+		self.forked  = 0.0  # seconds spent finding changes and forking
+		self.full    = False # True if the snapshot being written is a full one
+		self.games   = 0    # games in the snapshot being written
+		self.changed = None # (games, usernames) being written, see take
+		self.offset  = 0    # size of the journal when the snapshot was taken
+		self.written = 0    # bytes written by the last snapshot
+		self.stale   = False # True if the next snapshot has to be a full one
+
+	def start(self):
+		reactor.callLater(SNAPSHOT_INTERVAL, self.run)
+
+	def run(self):
+		# Skip this snapshot if the last one is still being written
+		if not self.child:
+			self.take()
+
+		reactor.callLater(SNAPSHOT_INTERVAL, self.run)
+
+	def changes(self):
+		"""
+		Returns (indexes of the games, usernames in the leaderboard) that
+		have changed since the last snapshot. Marks them as unchanged.
+		"""
+		games = []
+		for i, game in enumerate(self.server.games):
+			if game.dirty:
+				game.dirty = False
+				games.append(i)
+
+		leaderboard = self.server.leaderboard
+		usernames, leaderboard.changed = leaderboard.changed, set()
+		return games, usernames
+
+	def state(self):
+		"""Full snapshot of the server"""
+		return {
+			'version': VERSION,
+			'time': self.base,
+			'games': [game.snapshot() for game in self.server.games],
+			'leaderboard': self.server.leaderboard.points
+		}
+
+	def record(self, games, usernames):
+		"""Journal record with the given games and players"""
+		points = self.server.leaderboard.points
+		return {
+			'base': self.base,
+			'games': dict((i, self.server.games[i].snapshot()) for i in games),
+			'leaderboard': dict((username, points[username]) for username in usernames)
+		}
+
+	def take(self, fork = True):
+		"""
+		Starts writing a snapshot if anything has changed. Returns True if
+		it did. Without fork, the snapshot is written before returning.
+		"""
+		self.started = time.time()
+		games, usernames = self.changes()
+		self.offset = size(self.journal)
+		self.full = self.stale or self.base is None or self.offset > size(self.path) * SNAPSHOT_COMPACTION
+		if not (self.full or games or usernames):
+			return False
+
+		self.stale = False
+		# Freeing these while the child runs would copy the memory pages
+		# of everything in them, so keep them until it is done
+		self.changed = games, usernames
+		if self.full:
+			self.base = self.started
+			self.games = len(self.server.games)
+		else:
+			self.games = len(games)
+
+		if not fork or not hasattr(os, 'fork'):
+			self.finished(0 if self.write(games, usernames) else 1)
+			return True
+
+		pid = os.fork()
+		if pid == 0:
+			# The child. Never return to the reactor from here.
+			status = 1
+			try:
+				if self.write(games, usernames):
+					status = 0
+			finally:
+				os._exit(status)
+
+		self.child = pid
+		self.forked = time.time() - self.started
+		reactor.callLater(REAP_INTERVAL, self.reap)
+		return True
+
+	def write(self, games, usernames):
+		"""
+		Writes a full snapshot, or the given changes to the journal. Returns
+		False if it failed.
+		"""
+		try:
+			if self.full:
+				write(self.path, self.state())
+				# The records in the journal belong to the old snapshot
+				if os.path.exists(self.journal):
+					os.remove(self.journal)
+			else:
+				append(self.journal, self.record(games, usernames))
+		except (IOError, OSError, cPickle.PicklingError), e:
+			log.msg("Snapshot: Failed to write %s: %s" % (self.path if self.full else self.journal, e))
+			return False
+		return True
+
+	def reap(self):
+		"""Checks if the child has finished writing the snapshot"""
+		try:
+			pid, status = os.waitpid(self.child, os.WNOHANG)
+		except OSError:
+			pid, status = self.child, 1
+		if not pid:
+			reactor.callLater(REAP_INTERVAL, self.reap)
+			return
+
+		self.child = None
+		self.finished(status)
+
+	def finished(self, status):
+		self.changed = None
+		if status:
+			# Start over with a full snapshot next time
+			log.msg("Snapshot: Writing %s failed." % (self.path if self.full else self.journal))
+			self.stale = True
+			return
+
+		if self.full:
+			self.written = size(self.path)
+		else:
+			self.written = size(self.journal) - self.offset
+		log.msg("Snapshot: %s, %d games, %d bytes. %.1f ms in the reactor, written in %.1f ms." % (
+			"Full" if self.full else "Changes", self.games, self.written, self.forked * 1000, (time.time() - self.started) * 1000))
+
+	def save(self):
+		"""Writes a snapshot right away, e.g. when shutting down"""
+		if self.child:
+			pid, status = os.waitpid(self.child, 0)
+			self.child = None
+			self.finished(status)
+
+		self.take(fork = False)
+
+	def load(self):
+		"""Returns the snapshot on disk as (games, leaderboard points), or None"""
+		if not os.path.exists(self.path):
+			return None
+
+		start = time.time()
+		applied = 0
+		# Nothing loaded can be garbage, so don't look for it while
+		# creating millions of objects
+		gc.disable()
+		try:
+			try:
+				f = open(self.path, 'rb')
+				try:
+					snapshot = cPickle.load(f)
+				finally:
+					f.close()
+			except (IOError, EOFError, cPickle.UnpicklingError), e:
+				log.msg("Snapshot: Failed to read %s: %s" % (self.path, e))
+				return None
+
+			if snapshot.get('version') != VERSION:
+				log.msg("Snapshot: Ignoring %s, unknown version." % self.path)
+				return None
+
+			self.base = snapshot['time']
+			games = dict(enumerate(snapshot['games']))
+			points = snapshot['leaderboard']
+
+			if os.path.exists(self.journal):
+				try:
+					f = open(self.journal, 'rb')
+					try:
+						for record in records(f):
+							if record['base'] != self.base:
+								self.stale = True
+								continue
+							games.update(record['games'])
+							points.update(record['leaderboard'])
+							applied += 1
+					finally:
+						f.close()
+				except (IOError, ValueError, EOFError, cPickle.UnpicklingError), e:
+					# Keep what we have, and don't append to a damaged journal
+					log.msg("Snapshot: Failed to read %s: %s" % (self.journal, e))
+					self.stale = True
+		finally:
+			gc.enable()
+
+		log.msg("Snapshot: Loaded %d games and %d players, %d changes, in %.1f ms" % (
+			len(games), len(points), applied, (time.time() - start) * 1000))
+		return [games[i] for i in sorted(games)], points
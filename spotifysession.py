@@ -1,22 +1,54 @@
+import audio
+
 import threading
 
 from spotify.manager import SpotifySessionManager
 from spotify import Link, SpotifyError
 
-try:
-    from spotify.alsahelper import AlsaController
-except ImportError:
-    from spotify.osshelper import OssController as AlsaController
+# Seconds to wait for the audio thread to finish when the session ends
+AUDIO_CLOSE_TIMEOUT = 1.0
+
+
+def audio_controller():
+	"""
+	Returns a new audio controller. The audio helpers are imported here, 
+	so clients that don't play music never load them.
+	"""
+	try:
+		from spotify.alsahelper import AlsaController
+	except ImportError:
+		from spotify.osshelper import OssController as AlsaController
+	
+	return AlsaController()
 
 
 class SpotifySession(SpotifySessionManager, threading.Thread):
 	def __init__(self, *args, **kwargs):
+		play_music = kwargs.pop('play_music', True)
+		# Anything with the write method of audio.NullSink. Defaults to the sound card.
+		sink = kwargs.pop('sink', None)
+		
+		# Called from the session thread. They are set before the thread
+		# starts, so no update can arrive before we have them.
+		#  metadata_updated_callback(session) when there is new metadata
+		#  ready_callback(session) once, when we have logged in and received
+		#   the first metadata. Nothing should be loaded before this.
+		#  login_failed_callback(error) if we could not log in
+		self.metadata_updated_callback = kwargs.pop('metadata_updated_callback', None)
+		self.ready_callback = kwargs.pop('ready_callback', None)
+		self.login_failed_callback = kwargs.pop('login_failed_callback', None)
+		
 		threading.Thread.__init__(self)
 		SpotifySessionManager.__init__(self, *args, **kwargs)
 
-		self.audio = AlsaController()
+		self.audio = None
+		if play_music:
+			if not sink:
+				sink = audio.ControllerSink(audio_controller())
+			self.audio = audio.AudioOutput(sink)
 		self.playing = False
 		self.loaded_tracks = []
+		self.ready = False
 		self.start()
 		
 	def run(self):
@@ -24,8 +56,10 @@ class SpotifySession(SpotifySessionManager, threading.Thread):
 	
 	def logged_in(self, session, error):
 		if error:
-			# TODO: Halt the client
-			print 'sp_error: ', error
+			print 'Failed to log in to Spotify: ', error
+			if self.login_failed_callback:
+				self.login_failed_callback(error)
+			return
 
 		self.session = session
 	
@@ -40,7 +74,13 @@ class SpotifySession(SpotifySessionManager, threading.Thread):
 		Called when libspotify has new metadata.
 		"""
 		self.playlist_container = session.playlist_container()
-		self.metadata_updated_callback(self)
+		if self.metadata_updated_callback:
+			self.metadata_updated_callback(self)
+		
+		if not self.ready and self.is_loaded():
+			self.ready = True
+			if self.ready_callback:
+				self.ready_callback(self)
 
 	def load_track(self, track):
 		if self.playing:
@@ -72,12 +112,36 @@ class SpotifySession(SpotifySessionManager, threading.Thread):
 				img.add_load_callback(callback, userdata)
 		
 	def play(self):
+		if self.audio:
+			self.audio.play()
 		self.session.play(1)
 		self.playing = True
 	
 	def stop(self):
 		self.session.play(0)
+		if self.audio:
+			if self.playing:
+				self.report_audio()
+			self.audio.flush()
 		self.playing = False
 	
+	def report_audio(self):
+		"""Prints how the audio output did while playing the last track"""
+		latency = self.audio.first_frame_latency
+		if latency is None:
+			print 'Audio: no frames played, %d underruns' % self.audio.underruns
+		else:
+			print 'Audio: first frame after %.1f ms, %d underruns' % (latency * 1000, self.audio.underruns)
+	
+	def terminate(self):
+		"""Ends the session and stops the audio thread"""
+		SpotifySessionManager.terminate(self)
+		if self.audio:
+			self.audio.close()
+			self.audio.join(AUDIO_CLOSE_TIMEOUT)
+	
 	def music_delivery(self, *args, **kwargs):
+		"""Called from libspotify with PCM data. Only copies it to the audio buffer."""
+		if not self.audio:
+			return 0
 		return self.audio.music_delivery(*args, **kwargs)